@@ -0,0 +1,125 @@
+import base64
+import hashlib
+import logging
+import os
+import re
+import time
+
+# The MIME bundle entries that can be moved to the blob store, and the file extension used for each.
+# Binary types are base64-encoded in notebook outputs, and are stored decoded.
+binary_types = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "application/pdf": ".pdf",
+}
+text_types = {
+    "image/svg+xml": ".svg",
+    "text/html": ".html",
+}
+extensions = {**binary_types, **text_types}
+content_types = {ext: mime for mime, ext in extensions.items()}
+
+# Blobs are named by the sha256 of their content followed by their extension
+blob_name = re.compile(r"^[0-9a-f]{64}\.[a-z]+$")
+
+
+def unarray(v):
+    # Notebook MIME bundle values can be given as an array of lines
+    if isinstance(v, list):
+        return "".join(v)
+    return v
+
+
+class BlobStore:
+    """
+    BlobStore moves large entries of outputs' MIME bundles (images, pdfs, large html) into
+    deduplicated files named by the hash of their content. The output keeps only a reference, in its "blobs" field,
+    mapping the MIME type to the blob's name. All methods do blocking file IO, and are meant to be run in an executor.
+    """
+
+    _log = logging.getLogger("notebook.BlobStore")
+
+    def __init__(self, folder, min_size=16384):
+        self.folder = folder
+        self.min_size = min_size
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.folder, name[:2], name)
+
+    def content_type(self, name):
+        return content_types[os.path.splitext(name)[1]]
+
+    def put(self, mimetype, value):
+        if mimetype in binary_types:
+            content = base64.b64decode(value)
+        else:
+            content = value.encode("utf-8")
+        name = hashlib.sha256(content).hexdigest() + extensions[mimetype]
+        fpath = self.path(name)
+        if os.path.exists(fpath):
+            # Refresh the modification time, so that the blob is not garbage collected while it is being referenced
+            os.utime(fpath)
+            return name
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        tmppath = f"{fpath}.{os.getpid()}.tmp"
+        with open(tmppath, "wb") as f:
+            f.write(content)
+        os.replace(tmppath, fpath)
+        return name
+
+    def get(self, mimetype, name):
+        with open(self.path(name), "rb") as f:
+            content = f.read()
+        if mimetype in binary_types:
+            return base64.b64encode(content).decode("ascii")
+        return content.decode("utf-8")
+
+    def is_large(self, output):
+        # Whether the output has entries that should be moved to the blob store
+        if not "data" in output:
+            return False
+        for mimetype, v in output["data"].items():
+            if mimetype in extensions and len(unarray(v)) >= self.min_size:
+                return True
+        return False
+
+    def externalize(self, output):
+        for mimetype in list(output["data"].keys()):
+            v = unarray(output["data"][mimetype])
+            if mimetype in extensions and len(v) >= self.min_size:
+                if not "blobs" in output:
+                    output["blobs"] = {}
+                output["blobs"][mimetype] = self.put(mimetype, v)
+                del output["data"][mimetype]
+        return output
+
+    def internalize(self, output):
+        # Returns a copy of the output with the referenced blobs put back into its MIME bundle
+        if not "blobs" in output:
+            return output
+        output = {**output, "data": {**output.get("data", {})}}
+        for mimetype, name in output.pop("blobs").items():
+            try:
+                output["data"][mimetype] = self.get(mimetype, name)
+            except FileNotFoundError:
+                self._log.warning(f"Missing blob {name}")
+        return output
+
+    def collect(self, referenced, grace=3600):
+        # Removes blobs that are not in the referenced set. Blobs modified within the past grace seconds
+        # are kept, since they might belong to outputs that were not yet written to the database.
+        removed = 0
+        cutoff = time.time() - grace
+        for d in os.listdir(self.folder):
+            dpath = os.path.join(self.folder, d)
+            if not os.path.isdir(dpath):
+                continue
+            for name in os.listdir(dpath):
+                fpath = os.path.join(dpath, name)
+                if name not in referenced and os.path.getmtime(fpath) < cutoff:
+                    os.remove(fpath)
+                    removed += 1
+        self._log.debug(f"Removed {removed} unreferenced blobs")
+        return removed
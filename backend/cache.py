@@ -0,0 +1,92 @@
+import logging
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    LRUCache keeps recently used values, evicting the least recently used ones once their total size
+    is over max_size. Keys are tuples whose first element is the group they belong to (a notebook's object id),
+    so that all of a notebook's entries can be invalidated at once.
+
+    A value read from the database is only stored if nothing in its group was invalidated since the read started
+    (given by token()), so that a read which raced with a write can't put stale data in the cache.
+    """
+
+    _log = logging.getLogger("notebook.LRUCache")
+
+    def __init__(self, max_size=32 * 1024 * 1024):
+        self.max_size = max_size
+        # Maps key to (size, value), in order of least to most recently used
+        self.entries = OrderedDict()
+        # Maps group to the set of its keys in the cache
+        self.groups = {}
+        self.size = 0
+        # Each invalidation increments epoch, and records it for the group in invalidated. Once invalidated holds
+        # max_invalidated groups, it is cleared, and reads started before floor are no longer stored.
+        self.epoch = 0
+        self.invalidated = {}
+        self.floor = 0
+        self.max_invalidated = 10000
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def token(self):
+        return self.epoch
+
+    def put(self, key, value, size, token):
+        if (
+            token < self.floor
+            or self.invalidated.get(key[0], -1) >= token
+            or size > self.max_size
+        ):
+            return
+        self._remove(key)
+        self.entries[key] = (size, value)
+        self.groups.setdefault(key[0], set()).add(key)
+        self.size += size
+        while self.size > self.max_size:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry[0]
+        keys = self.groups[key[0]]
+        keys.discard(key)
+        if len(keys) == 0:
+            del self.groups[key[0]]
+
+    def invalidate(self, group, keys=None):
+        # Removes the given keys, or all keys of the group if none are given
+        self.invalidated[group] = self.epoch
+        self.epoch += 1
+        if len(self.invalidated) > self.max_invalidated:
+            self.invalidated = {}
+            self.floor = self.epoch
+        if keys is None:
+            keys = list(self.groups.get(group, []))
+        for key in keys:
+            self._remove(key)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "size": self.size,
+            "max_size": self.max_size,
+        }
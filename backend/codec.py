@@ -0,0 +1,30 @@
+# The JSON codec used for kernel messages, stored cells and responses. orjson and ujson are several times
+# faster than the standard library on large outputs, so they are used when installed.
+# dumps always returns a str, and default is called for objects that can't otherwise be serialized.
+try:
+    import orjson
+
+    name = "orjson"
+    loads = orjson.loads
+
+    def dumps(obj, default=None):
+        return orjson.dumps(obj, default=default).decode("utf-8")
+
+except ImportError:
+    try:
+        import ujson
+
+        name = "ujson"
+        loads = ujson.loads
+
+        def dumps(obj, default=None):
+            return ujson.dumps(obj, ensure_ascii=False, default=default)
+
+    except ImportError:
+        import json
+
+        name = "json"
+        loads = json.loads
+
+        def dumps(obj, default=None):
+            return json.dumps(obj, ensure_ascii=False, default=default)
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+
+class Database:
+    """
+    Database holds long-lived connections to heedy's sqlite database: a single writer, whose use is
+    serialized with a lock, and a pool of read-only connections. The database is put in WAL mode,
+    so that readers are not blocked by the writer.
+    """
+
+    _log = logging.getLogger("notebook.Database")
+
+    def __init__(self, path, readers=4, busy_timeout=5000, cached_statements=256):
+        self.path = path
+        self.readers = readers
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+
+        self.writer = None
+        self.write_lock = asyncio.Lock()
+        self.reader_pool = asyncio.Queue()
+        self.connections = []
+
+    async def _connect(self, readonly=False):
+        # sqlite3 keeps a cache of prepared statements for each connection, keyed by the query string
+        db = await aiosqlite.connect(
+            self.path,
+            timeout=self.busy_timeout / 1000,
+            cached_statements=self.cached_statements,
+        )
+        await db.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        await db.execute("PRAGMA foreign_keys=1")
+        if readonly:
+            await db.execute("PRAGMA query_only=1")
+        self.connections.append(db)
+        return db
+
+    async def open(self):
+        self.writer = await self._connect()
+        async with self.writer.execute("PRAGMA journal_mode=WAL") as c:
+            mode = (await c.fetchone())[0]
+        if mode != "wal":
+            self._log.warning(f"Could not enable WAL mode, using {mode}")
+        for i in range(self.readers):
+            self.reader_pool.put_nowait(await self._connect(readonly=True))
+        self._log.debug(f"Opened {self.path} with {self.readers} readers")
+
+    async def close(self):
+        for db in self.connections:
+            await db.close()
+        self.connections = []
+        self.writer = None
+
+    async def migrate(self, migrations):
+        # migrations[i] is the list of statements that upgrades the schema from version i to i+1.
+        # The current version is stored in the notebook_schema table.
+        async with self.write() as db:
+            await db.execute(
+                "CREATE TABLE IF NOT EXISTS notebook_schema (version INTEGER NOT NULL);"
+            )
+            rows = await db.execute_fetchall("SELECT version FROM notebook_schema;")
+            if len(rows) == 0:
+                version = 0
+                await db.execute("INSERT INTO notebook_schema (version) VALUES (0);")
+            else:
+                version = rows[0][0]
+            await db.commit()
+            # sqlite3 commits each DDL statement on its own outside of an explicit transaction, so each migration
+            # runs in its own transaction, together with its version update, to be rolled back entirely if it fails
+            for i in range(version, len(migrations)):
+                self._log.info(f"Migrating notebook schema to version {i+1}")
+                await db.execute("BEGIN;")
+                try:
+                    for stmt in migrations[i]:
+                        await db.execute(stmt)
+                    await db.execute("UPDATE notebook_schema SET version=?;", (i + 1,))
+                except:
+                    await db.rollback()
+                    raise
+                await db.commit()
+
+    @asynccontextmanager
+    async def write(self):
+        # Gives exclusive use of the writer connection. The transaction is committed when the block exits,
+        # or rolled back if it raised an exception.
+        async with self.write_lock:
+            try:
+                yield self.writer
+            except:
+                await self.writer.rollback()
+                raise
+            await self.writer.commit()
+
+    @asynccontextmanager
+    async def savepoint(self, db, name="notebook_savepoint"):
+        # Used within a write block, so that if the block raises an exception, only its own changes are rolled back,
+        # and the rest of the transaction is still committed
+        if not db.in_transaction:
+            await db.execute("BEGIN;")
+        await db.execute(f"SAVEPOINT {name};")
+        try:
+            yield db
+        except:
+            await db.execute(f"ROLLBACK TO {name};")
+            await db.execute(f"RELEASE {name};")
+            raise
+        await db.execute(f"RELEASE {name};")
+
+    @asynccontextmanager
+    async def read(self, snapshot=False):
+        # With snapshot, all queries in the block see the database as it was at the first query,
+        # even if writes are committed in the meantime
+        db = await self.reader_pool.get()
+        try:
+            if snapshot:
+                await db.execute("BEGIN;")
+            try:
+                yield db
+            finally:
+                if snapshot:
+                    await db.rollback()
+        finally:
+            self.reader_pool.put_nowait(db)
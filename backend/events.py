@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from collections import deque
+
+
+def merge_event_data(event, old, new):
+    # Returns the data of a single event equivalent to sending the event with old data followed by the one with new data
+    if event == "notebook_run_progress" and "cells" in old and "cells" in new:
+        # Both runs cleared and queued cells
+        return {**new, "cells": old["cells"] + new["cells"]}
+    if event != "notebook_cell_outputs":
+        # Updates are partial, so later fields replace earlier ones
+        return {**old, **new}
+    if "ops" in old and "ops" in new and new["base_version"] == old["version"]:
+        return {
+            **new,
+            "base_version": old["base_version"],
+            "ops": old["ops"] + new["ops"],
+        }
+    # The changes can't be combined, so clients read the cell at the new version
+    return {"cell_id": new["cell_id"], "version": new["version"]}
+
+
+class EventDispatcher:
+    """
+    EventDispatcher sends events to heedy in the background, so that writes don't wait for each event's round trip.
+    Events of an object are sent in the order they were put, since clients apply cell updates in order,
+    while events of different objects are sent concurrently, with at most concurrency requests at a time.
+
+    Sending starts window seconds after an object's first queued event. An event that is put while the last queued
+    event of its object is for the same cell (or the object itself) is merged into it, much like the frontend merges
+    consecutive updates of a cell, so that bursts of updates or outputs become a single event.
+    """
+
+    _log = logging.getLogger("notebook.EventDispatcher")
+
+    def __init__(self, fire, concurrency=8, window=0.05):
+        self.fire = fire
+        self.window = window
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+        # Maps object id to the deque of its events that were not yet sent, and to the task sending them
+        self.queues = {}
+        self.senders = {}
+
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+
+    def put(self, event):
+        object_id = event["object"]
+        queue = self.queues.setdefault(object_id, deque())
+        if len(queue) > 0:
+            last = queue[-1]
+            if last["event"] == event["event"] and last["data"].get("cell_id") == event[
+                "data"
+            ].get("cell_id"):
+                last["data"] = merge_event_data(
+                    event["event"], last["data"], event["data"]
+                )
+                self.merged += 1
+                return
+        queue.append(dict(event))
+        if object_id not in self.senders:
+            self.senders[object_id] = asyncio.create_task(self._send(object_id))
+
+    async def _send(self, object_id):
+        queue = self.queues[object_id]
+        try:
+            await asyncio.sleep(self.window)
+            while len(queue) > 0:
+                # The event leaves the queue before it is sent, so that nothing is merged into it while sending
+                event = queue.popleft()
+                async with self.semaphore:
+                    try:
+                        await self.fire(event)
+                        self.sent += 1
+                    except Exception as e:
+                        # Events of deleted objects fail to send
+                        self.failed += 1
+                        self._log.debug(
+                            f"Failed to send {event['event']} for {object_id}: {e}"
+                        )
+        finally:
+            del self.senders[object_id]
+            del self.queues[object_id]
+
+    async def flush(self):
+        # Waits until all queued events were sent
+        while len(self.senders) > 0:
+            await asyncio.gather(*self.senders.values(), return_exceptions=True)
+
+    def stats(self):
+        return {
+            "queued": sum(len(q) for q in self.queues.values()),
+            "sent": self.sent,
+            "merged": self.merged,
+            "failed": self.failed,
+        }
@@ -0,0 +1,62 @@
+import uuid
+
+import ijson
+
+
+class IpynbReader:
+    """
+    IpynbReader parses an uploaded .ipynb file incrementally. Each chunk of the file given to feed returns
+    the cells that were completed by it, converted to heedy's cell format, so that the whole file never needs to be in memory.
+    Parsing is blocking, so feed is meant to be run in an executor.
+    """
+
+    def __init__(self):
+        self.events = ijson.sendable_list()
+        self.parser = ijson.parse_coro(self.events, use_float=True)
+        self.builder = None
+        self.cells = 0
+
+        # The notebook's language, which is only known once metadata was read (usually after the cells)
+        self.language = None
+
+    def feed(self, chunk):
+        # An empty chunk marks the end of the file
+        if len(chunk) == 0:
+            self.parser.close()
+        else:
+            self.parser.send(chunk)
+
+        cells = []
+        for prefix, event, value in self.events:
+            if self.builder is not None:
+                self.builder.event(event, value)
+                if prefix == "cells.item" and event == "end_map":
+                    cell = self.convert(self.builder.value)
+                    if cell is not None:
+                        cells.append(cell)
+                    self.builder = None
+            elif prefix == "cells.item" and event == "start_map":
+                self.builder = ijson.ObjectBuilder()
+                self.builder.event(event, value)
+            elif prefix == "metadata.language_info.name" and event == "string":
+                self.language = value
+        del self.events[:]
+        return cells
+
+    def convert(self, c):
+        self.cells += 1
+        source = c.get("source", "")
+        if isinstance(source, list):
+            source = "".join(source)
+        if self.cells == 1 and "HEEDY NOTEBOOK HEADER" in source:
+            # Remove the heedy header
+            return None
+        cell = {
+            "cell_id": uuid.uuid4().hex,
+            "cell_type": c["cell_type"],
+            "source": source,
+            "metadata": c.get("metadata", {}),
+        }
+        if "outputs" in c:
+            cell["outputs"] = c["outputs"]
+        return cell
@@ -1,16 +1,25 @@
 import asyncio
 import aiohttp
+import ijson
 from aiohttp import web
 import os
 from heedy import Plugin
 import signal
-import json
 import logging
-import aiosqlite
 import uuid
 from datetime import datetime
-import re
 import manager
+from blobs import BlobStore, blob_name
+from cache import LRUCache
+from codec import dumps, loads
+from db import Database
+from events import EventDispatcher
+from ipynb_reader import IpynbReader
+from outputs import OutputBuffer, output_size
+from resources import LimitExceeded, ResourceLimits
+from scheduler import Scheduler
+from terminal import TerminalText
+from workers import LoopMonitor, Workers
 
 
 p = Plugin()
@@ -22,36 +31,166 @@ else:
     logging.basicConfig(level=logging.INFO)
 l = logging.getLogger("notebook")
 
+# Optional settings, which can be given in the config block of the notebook plugin in heedy.conf
+settings = (
+    p.config["config"].get("plugin", {}).get(p.name, {}).get("config", None) or {}
+)
+
 config_file = os.path.join(p.config["plugin_dir"], "backend", "jupyter_heedy_config.py")
 ipy_config = os.path.join(p.config["plugin_dir"], "backend", "ipynb")
 
 
 routes = web.RouteTableDef()
 
-schema = """
-CREATE TABLE notebook_cells (
-    object_id VARCHAR NOT NULL,
-
-    cell_id VARCHAR NOT NULL,
-    cell_index INTEGER NOT NULL,
-
-    cell_type STRING NOT NULL DEFAULT 'code',
-    source VARCHAR NOT NULL DEFAULT '',
-    outputs VARCHAR NOT NULL DEFAULT '[]',
-    metadata VARCHAR NOT NULL DEFAULT '{}',
-
-    PRIMARY KEY (object_id,cell_id),
-
-    CONSTRAINT valid_outputs CHECK (json_valid(outputs) AND json_type(outputs)='array'),
-    CONSTRAINT valid_metadata CHECK (json_valid(metadata) AND json_type(metadata)='object'),
-
-    CONSTRAINT notebook_object
-        FOREIGN KEY(object_id)
-        REFERENCES objects(id)
-        ON UPDATE CASCADE
-        ON DELETE CASCADE
-);
-"""
+# Cells are ordered by cell_index, which is kept sparse, with ORDER_GAP between cells when they are appended or
+# rebalanced. This way, inserting or moving a cell only needs to modify that cell. The API returns the cell's position
+# in the notebook as its cell_index.
+ORDER_GAP = 1 << 20
+
+# The database schema, as a list of migrations. Migration i upgrades the schema from version i to i+1,
+# and new migrations are always appended to the end.
+migrations = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS notebook_cells (
+            object_id VARCHAR NOT NULL,
+
+            cell_id VARCHAR NOT NULL,
+            cell_index INTEGER NOT NULL,
+
+            cell_type STRING NOT NULL DEFAULT 'code',
+            source VARCHAR NOT NULL DEFAULT '',
+            outputs VARCHAR NOT NULL DEFAULT '[]',
+            metadata VARCHAR NOT NULL DEFAULT '{}',
+
+            PRIMARY KEY (object_id,cell_id),
+
+            CONSTRAINT valid_outputs CHECK (json_valid(outputs) AND json_type(outputs)='array'),
+            CONSTRAINT valid_metadata CHECK (json_valid(metadata) AND json_type(metadata)='object'),
+
+            CONSTRAINT notebook_object
+                FOREIGN KEY(object_id)
+                REFERENCES objects(id)
+                ON UPDATE CASCADE
+                ON DELETE CASCADE
+        );
+        """
+    ],
+    [
+        # Switch from dense to sparse cell ordering
+        f"UPDATE notebook_cells SET cell_index=cell_index*{ORDER_GAP};",
+        "CREATE INDEX notebook_cells_order ON notebook_cells(object_id,cell_index);",
+    ],
+    [
+        # Move outputs from a JSON array column to their own table, with one row per output
+        "DROP INDEX notebook_cells_order;",
+        "ALTER TABLE notebook_cells RENAME TO notebook_cells_old;",
+        """
+        CREATE TABLE notebook_cells (
+            object_id VARCHAR NOT NULL,
+
+            cell_id VARCHAR NOT NULL,
+            cell_index INTEGER NOT NULL,
+
+            cell_type STRING NOT NULL DEFAULT 'code',
+            source VARCHAR NOT NULL DEFAULT '',
+            metadata VARCHAR NOT NULL DEFAULT '{}',
+
+            PRIMARY KEY (object_id,cell_id),
+
+            CONSTRAINT valid_metadata CHECK (json_valid(metadata) AND json_type(metadata)='object'),
+
+            CONSTRAINT notebook_object
+                FOREIGN KEY(object_id)
+                REFERENCES objects(id)
+                ON UPDATE CASCADE
+                ON DELETE CASCADE
+        );
+        """,
+        "INSERT INTO notebook_cells (object_id,cell_id,cell_index,cell_type,source,metadata) SELECT object_id,cell_id,cell_index,cell_type,source,metadata FROM notebook_cells_old;",
+        "CREATE INDEX notebook_cells_order ON notebook_cells(object_id,cell_index);",
+        """
+        CREATE TABLE notebook_cell_outputs (
+            object_id VARCHAR NOT NULL,
+            cell_id VARCHAR NOT NULL,
+            -- The index of the output in the cell's outputs array
+            seq INTEGER NOT NULL,
+            output VARCHAR NOT NULL,
+
+            PRIMARY KEY (object_id,cell_id,seq),
+
+            CONSTRAINT valid_output CHECK (json_valid(output) AND json_type(output)='object'),
+
+            CONSTRAINT output_cell
+                FOREIGN KEY(object_id,cell_id)
+                REFERENCES notebook_cells(object_id,cell_id)
+                ON UPDATE CASCADE
+                ON DELETE CASCADE
+        );
+        """,
+        "INSERT INTO notebook_cell_outputs (object_id,cell_id,seq,output) SELECT object_id,cell_id,json_each.key,json_each.value FROM notebook_cells_old, json_each(outputs);",
+        "DROP TABLE notebook_cells_old;",
+    ],
+    [
+        # Version counters, used for ETags and to let clients skip fetching cells they already have
+        "ALTER TABLE notebook_cells ADD COLUMN version INTEGER NOT NULL DEFAULT 0;",
+        """
+        CREATE TABLE notebook_versions (
+            object_id VARCHAR NOT NULL PRIMARY KEY,
+            -- Incremented by each write to the notebook. The cells modified by the write are given the new version.
+            version INTEGER NOT NULL DEFAULT 0,
+
+            CONSTRAINT notebook_version_object
+                FOREIGN KEY(object_id)
+                REFERENCES objects(id)
+                ON UPDATE CASCADE
+                ON DELETE CASCADE
+        );
+        """,
+    ],
+    [
+        """
+        CREATE TABLE notebook_schedules (
+            object_id VARCHAR NOT NULL PRIMARY KEY,
+            -- The user whose kernels run the notebook
+            owner VARCHAR NOT NULL,
+            -- A crontab schedule, in the plugin's local time
+            cron VARCHAR NOT NULL,
+            enabled BOOLEAN NOT NULL DEFAULT TRUE,
+
+            -- Unix timestamps of the next and last runs, and how the last run finished
+            next_run REAL,
+            last_run REAL,
+            last_status VARCHAR,
+
+            CONSTRAINT notebook_schedule_object
+                FOREIGN KEY(object_id)
+                REFERENCES objects(id)
+                ON UPDATE CASCADE
+                ON DELETE CASCADE
+        );
+        """,
+        "CREATE INDEX notebook_schedules_next_run ON notebook_schedules(next_run) WHERE enabled;",
+    ],
+]
+
+# Reassembles a cell's outputs array from the notebook_cell_outputs table, for use in queries on notebook_cells c
+outputs_query = "(SELECT json_group_array(json(output)) FROM (SELECT output FROM notebook_cell_outputs o WHERE o.object_id=c.object_id AND o.cell_id=c.cell_id ORDER BY seq))"
+# The position of the cell c in its notebook
+position_query = "(SELECT count(*) FROM notebook_cells c2 WHERE c2.object_id=c.object_id AND c2.cell_index<c.cell_index)"
+
+# The fields of a cell returned by the api, and the columns they are read from. outputs and metadata are
+# stored as JSON text, which is spliced into responses as-is, without decoding and encoding it again.
+cell_columns = {
+    "cell_id": "cell_id",
+    "cell_index": position_query,
+    "source": "source",
+    "outputs": outputs_query,
+    "metadata": "metadata",
+    "cell_type": "cell_type",
+    "version": "version",
+}
+json_columns = {"outputs", "metadata"}
 
 sqldb = p.config["config"]["sql"]
 if not sqldb.startswith("sqlite3://"):
@@ -60,45 +199,197 @@ sqldb = os.path.abspath(sqldb[10:].split("?")[0])
 l.debug(f"Using database at {sqldb}")
 
 
-def connect_to_database():
-    return aiosqlite.connect(sqldb)
+blob_store = BlobStore(
+    os.path.join(p.config["data_dir"], "notebook_outputs"),
+    min_size=settings.get("blob_min_size", 16384),
+)
+
+database = Database(
+    sqldb,
+    readers=settings.get("db_readers", 4),
+    busy_timeout=settings.get("db_busy_timeout", 5000),
+)
+
+# Recently read notebooks and cells, as rows of their stored columns. Every write to a cell invalidates
+# its entries once it was committed.
+cache = LRUCache(max_size=settings.get("cache_size", 32 * 1024 * 1024))
+# The number of cells read at a time when reading a whole notebook
+notebook_page_size = settings.get("notebook_page_size", 200)
+# The number of times a whole notebook is read in pages while it is being changed, before reading it in a snapshot
+notebook_read_attempts = settings.get("notebook_read_attempts", 3)
+workers = Workers(
+    kind=settings.get("worker_kind", "thread"),
+    max_workers=settings.get("worker_count", 4),
+    offload_size=settings.get("worker_offload_size", 65536),
+)
+loop_monitor = LoopMonitor()
+events = EventDispatcher(
+    p.fire,
+    concurrency=settings.get("event_concurrency", 8),
+    window=settings.get("event_window", 0.05),
+)
+
+
+async def bump_version(db, object_id):
+    # Increments the notebook's version within the current write transaction, and returns the new version.
+    # Returns None if the object was deleted, since writes can still arrive afterwards, for example outputs
+    # of a kernel that is being shut down.
+    await db.execute(
+        "INSERT INTO notebook_versions (object_id,version) SELECT id,1 FROM objects WHERE id=? ON CONFLICT(object_id) DO UPDATE SET version=version+1;",
+        (object_id,),
+    )
+    rows = await db.execute_fetchall(
+        "SELECT version FROM notebook_versions WHERE object_id=?;", (object_id,)
+    )
+    if len(rows) == 0:
+        return None
+    return rows[0][0]
+
+
+def chunks(items, size=500):
+    # Splits a list into parts small enough to be used as the values of an IN (...) query
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+async def externalize_outputs(outputs):
+    # Moves large MIME bundle entries of the outputs into the blob store, in place
+    loop = asyncio.get_event_loop()
+    for o in outputs:
+        if blob_store.is_large(o):
+            await loop.run_in_executor(None, blob_store.externalize, o)
+
+
+async def internalize_outputs(outputs):
+    # Returns the outputs with blob references replaced by their content
+    loop = asyncio.get_event_loop()
+    return [
+        await loop.run_in_executor(None, blob_store.internalize, o)
+        if "blobs" in o
+        else o
+        for o in outputs
+    ]
+
+
+class CellOrder:
+    """
+    CellOrder holds the order of a notebook's cells in memory while a set of modifications is planned,
+    assigning sparse cell_index values to inserted and moved cells.
+    """
+
+    def __init__(self, rows):
+        self.ids = [row[0] for row in rows]
+        self.index = {row[0]: row[1] for row in rows}
+        # The cells whose cell_index was changed
+        self.changed = set()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def position(self, cell_id):
+        return self.ids.index(cell_id)
+
+    def remove(self, cell_id):
+        self.ids.remove(cell_id)
+        del self.index[cell_id]
+        self.changed.discard(cell_id)
+
+    def insert(self, position, cell_id):
+        # Inserts the cell at the given position, which must be at most len(self)
+        before = self.index[self.ids[position - 1]] if position > 0 else None
+        after = self.index[self.ids[position]] if position < len(self.ids) else None
+        self.ids.insert(position, cell_id)
+        self.changed.add(cell_id)
+
+        if before is None and after is None:
+            self.index[cell_id] = 0
+        elif before is None:
+            self.index[cell_id] = after - ORDER_GAP
+        elif after is None:
+            self.index[cell_id] = before + ORDER_GAP
+        elif after - before > 1:
+            self.index[cell_id] = (before + after) // 2
+        else:
+            # There is no space left between the two cells, so spread out all cells in the notebook again
+            l.debug("Rebalancing cell order")
+            for i, cid in enumerate(self.ids):
+                self.index[cid] = i * ORDER_GAP
+            self.changed.update(self.ids)
 
 
 async def save_notebook_modifications(object_id, data):
     l.info(f"Updating notebook {object_id}")
     # object_id is the object to modify, and data is an *array* of cell modifications, which allows saving
-    # the entire notebook at once, while maintaining ordering necessary for allowing cell index changes/inserts/deletes
+    # the entire notebook at once, while maintaining ordering necessary for allowing cell index changes/inserts/deletes.
+    # All modifications are first planned in memory, and then written with a handful of bulk queries.
     event_data = []
 
-    async with connect_to_database() as db:
-        await db.execute("PRAGMA foreign_keys=1")
+    for cell in data:
+        if "outputs" in cell:
+            await externalize_outputs(cell["outputs"])
+
+    async with database.write() as db:
+        version = await bump_version(db, object_id)
+        if version is None:
+            l.warning(f"Not updating notebook {object_id}, which no longer exists")
+            return
+        order = CellOrder(
+            await db.execute_fetchall(
+                "SELECT cell_id,cell_index FROM notebook_cells WHERE object_id=? ORDER BY cell_index ASC;",
+                (object_id,),
+            )
+        )
+        existing = set(order.ids)
 
-        for cell in data:
+        # The events need the full cell, so read the current values of cells that are updated without setting all of their fields
+        cells = {}
+        missing = list(
+            {
+                c["cell_id"]
+                for c in data
+                if "cell_id" in c
+                and c["cell_id"] in existing
+                and not ("delete" in c and c["delete"])
+                and not ("source" in c and "metadata" in c and "cell_type" in c)
+            }
+        )
+        for ids in chunks(missing):
+            rows = await db.execute_fetchall(
+                f"SELECT cell_id,source,metadata,cell_type FROM notebook_cells WHERE object_id=? AND cell_id IN ({','.join('?'*len(ids))});",
+                [object_id] + ids,
+            )
+            for row in rows:
+                cells[row[0]] = {
+                    "source": row[1],
+                    "metadata": loads(row[2]),
+                    "cell_type": row[3],
+                }
 
+        deleted = set()  # Existing cells to delete
+        inserted = set()  # New cells to insert
+        updated = set()  # Existing cells whose source, metadata or cell_type changed
+        outputs = {}  # The cells whose outputs were set
+        touched = (
+            set()
+        )  # Existing cells that were given in data, which get the new version
+
+        for cell in data:
             if "delete" in cell and cell["delete"]:
                 cell_id = cell["cell_id"]
+                if not cell_id in order.index:
+                    l.warning(f"Deleting nonexistent cell {object_id}/{cell_id}")
+                    continue
                 l.debug(f"Deleting cell {object_id}/{cell_id}")
-                # On a cell delete, we need to shift indices of cells after it
-                c = await db.execute(
-                    "SELECT cell_index FROM notebook_cells WHERE object_id=? AND cell_id=?;",
-                    (object_id, cell_id),
-                )
-                cell_index = int((await c.fetchone())[0])
-                await c.close()
-
-                await db.execute(
-                    "DELETE FROM notebook_cells WHERE object_id=? AND cell_id=?;",
-                    (object_id, cell_id),
-                )
-                await db.execute(
-                    "UPDATE notebook_cells SET cell_index=cell_index-1 WHERE object_id=? AND cell_index>?",
-                    (object_id, cell_index),
-                )
-
-                await db.execute(
-                    "DELETE FROM notebook_cells WHERE object_id=? AND cell_id=?;",
-                    (object_id, cell_id),
-                )
+                cell_index = order.position(cell_id)
+                order.remove(cell_id)
+                if cell_id in inserted:
+                    inserted.remove(cell_id)
+                else:
+                    deleted.add(cell_id)
+                updated.discard(cell_id)
+                touched.discard(cell_id)
+                outputs.pop(cell_id, None)
+                forget_terminals(object_id, cell_id)
                 event_data.append(
                     {
                         "event": "notebook_cell_delete",
@@ -106,371 +397,625 @@ async def save_notebook_modifications(object_id, data):
                         "data": {"cell_id": cell_id, "cell_index": cell_index},
                     }
                 )
-            else:
-                # Now we want to find out if we want to create or update a cell. We create a new cell if there is no cell_id,
-                # or if the given cell_id does not exist yet
-                id_exists = "cell_id" in cell
-                if id_exists:
-                    c = await db.execute(
-                        "SELECT cell_id FROM notebook_cells WHERE object_id=? AND cell_id=?;",
-                        (object_id, cell["cell_id"]),
-                    )
-                    if (await c.fetchone()) is None:
-                        id_exists = False
-                    await c.close()
-
-                # Read the cell
-                if not id_exists:
-                    cell_id = None
-                    if "cell_id" in cell:
-                        cell_id = cell["cell_id"]
-                    else:
-                        cell_id = uuid.uuid4().hex
-                    l.debug(f"Creating new cell {object_id}/{cell_id}")
-
-                    # First, get the max index
-                    c = await db.execute(
-                        "SELECT COALESCE(max(cell_index),-1) FROM notebook_cells WHERE object_id=?;",
-                        (object_id,),
-                    )
-                    maxindex = int((await c.fetchone())[0])
-                    await c.close()
-
-                    index = -1
-                    if "cell_index" in cell:
-                        index = cell["cell_index"]
-
-                    if index == -1 or index > maxindex + 1:
-                        # If appending to the end
-                        index = maxindex + 1
-                    elif index <= maxindex:
-                        # We are inserting a cell somewhere in the middle of the document. Update the indices of all intermediate cells
-                        await db.execute(
-                            "UPDATE notebook_cells SET cell_index=cell_index+1 WHERE object_id=? AND cell_index>=?",
-                            (object_id, index),
-                        )
-
-                    # Prepare the insert query
-                    source = ""
-                    metadata = {}
-                    cell_type = "code"
-                    output = []
-                    if "source" in cell:
-                        source = cell["source"]
-                    if "metadata" in cell:
-                        metadata = cell["metadata"]
-                    if "cell_type" in cell:
-                        cell_type = cell["cell_type"]
-                    if "outputs" in cell:
-                        output = cell["outputs"]
-                    await db.execute(
-                        "INSERT INTO notebook_cells (object_id,cell_id,cell_index,source,metadata,cell_type,outputs) VALUES (?,?,?,?,?,?,?)",
-                        (
-                            object_id,
-                            cell_id,
-                            index,
-                            source,
-                            json.dumps(metadata),
-                            cell_type,
-                            json.dumps(output),
-                        ),
-                    )
+                continue
+
+            # Now we want to find out if we want to create or update a cell. We create a new cell if there is no cell_id,
+            # or if the given cell_id does not exist yet
+            cell_id = cell["cell_id"] if "cell_id" in cell else uuid.uuid4().hex
+            if not cell_id in order.index:
+                l.debug(f"Creating new cell {object_id}/{cell_id}")
+                index = -1
+                if "cell_index" in cell:
+                    index = cell["cell_index"]
+                if index == -1 or index > len(order):
+                    # If appending to the end
+                    index = len(order)
+                order.insert(index, cell_id)
+                inserted.add(cell_id)
+
+                cells[cell_id] = {
+                    "source": cell["source"] if "source" in cell else "",
+                    "metadata": cell["metadata"] if "metadata" in cell else {},
+                    "cell_type": cell["cell_type"] if "cell_type" in cell else "code",
+                }
+                if "outputs" in cell:
+                    outputs[cell_id] = cell["outputs"]
 
+                event_data.append(
+                    {
+                        "event": "notebook_cell_update",
+                        "object": object_id,
+                        "data": {
+                            "cell_id": cell_id,
+                            "cell_index": index,
+                            **cells[cell_id],
+                        },
+                    }
+                )
+                if "outputs" in cell and len(cell["outputs"]) > 0:
                     event_data.append(
                         {
-                            "event": "notebook_cell_update",
+                            "event": "notebook_cell_outputs",
                             "object": object_id,
-                            "data": {
-                                "cell_id": cell_id,
-                                "source": source,
-                                "cell_index": index,
-                                "metadata": metadata,
-                                "cell_type": cell_type,
-                            },
+                            "data": {"cell_id": cell_id, "version": version},
                         }
                     )
+                continue
+
+            l.debug(f"Updating cell {object_id}/{cell_id}")
+            touched.add(cell_id)
+            for k in ["source", "metadata", "cell_type"]:
+                if k in cell:
+                    cells.setdefault(cell_id, {})[k] = cell[k]
+                    if not cell_id in inserted:
+                        updated.add(cell_id)
+            if "outputs" in cell:
+                outputs[cell_id] = cell["outputs"]
+                forget_terminals(object_id, cell_id)
+
+            # Check if there was an index change, and move only this cell to its new position
+            cur_index = order.position(cell_id)
+            if "cell_index" in cell and cell["cell_index"] != cur_index:
+                target_index = cell["cell_index"]
+                if target_index < 0 or target_index > len(order) - 1:
+                    target_index = len(order) - 1
+                if target_index != cur_index:
+                    order.ids.remove(cell_id)
+                    order.insert(target_index, cell_id)
+                    cur_index = target_index
+
+            event_data.append(
+                {
+                    "event": "notebook_cell_update",
+                    "object": object_id,
+                    "data": {
+                        "cell_id": cell_id,
+                        "cell_index": cur_index,
+                        **cells[cell_id],
+                    },
+                }
+            )
+            if "outputs" in cell:
+                event_data.append(
+                    {
+                        "event": "notebook_cell_outputs",
+                        "object": object_id,
+                        "data": {"cell_id": cell_id, "version": version},
+                    }
+                )
 
-                    if "outputs" in cell and len(cell["outputs"]) > 0:
-                        event_data.append(
-                            {
-                                "event": "notebook_cell_outputs",
-                                "object": object_id,
-                                "data": {"cell_id": cell_id},
-                            }
-                        )
-                else:
-                    cell_id = cell["cell_id"]
-                    l.debug(f"Updating cell {object_id}/{cell_id}")
-
-                    setme = ""
-                    outputs = []
-                    if "source" in cell:
-                        setme = "source=?"
-                        outputs.append(cell["source"])
-                    if "metadata" in cell:
-                        if setme != "":
-                            setme += ","
-                        setme += "metadata=?"
-                        outputs.append(json.dumps(cell["metadata"]))
-                    if "cell_type" in cell:
-                        if setme != "":
-                            setme += ","
-                        setme += "cell_type=?"
-                        outputs.append(cell["cell_type"])
-                    if "outputs" in cell:
-                        if setme != "":
-                            setme += ","
-                        setme += "outputs=?"
-                        outputs.append(json.dumps(cell["outputs"]))
-
-                    outputs.append(object_id)
-                    outputs.append(cell_id)
-
-                    if setme != "":
-                        await db.execute(
-                            f"UPDATE notebook_cells SET {setme} WHERE object_id=? AND cell_id=?;",
-                            outputs,
-                        )
-
-                    # Next, prepare the event
-                    c = await db.execute(
-                        "SELECT source,metadata,cell_type,cell_index FROM notebook_cells WHERE object_id=? AND cell_id=?;",
-                        (object_id, cell_id),
+        # Finally, write the planned changes
+        if len(deleted) > 0:
+            await db.executemany(
+                "DELETE FROM notebook_cells WHERE object_id=? AND cell_id=?;",
+                [(object_id, cell_id) for cell_id in deleted],
+            )
+        if len(inserted) > 0:
+            await db.executemany(
+                "INSERT INTO notebook_cells (object_id,cell_id,cell_index,source,metadata,cell_type,version) VALUES (?,?,?,?,?,?,?)",
+                [
+                    (
+                        object_id,
+                        cell_id,
+                        order.index[cell_id],
+                        cells[cell_id]["source"],
+                        dumps(cells[cell_id]["metadata"]),
+                        cells[cell_id]["cell_type"],
+                        version,
                     )
-                    row = await c.fetchone()
-                    await c.close()
-                    cur_index = int(row[3])
-
-                    event_data.append(
-                        {
-                            "event": "notebook_cell_update",
-                            "object": object_id,
-                            "data": {
-                                "cell_id": cell_id,
-                                "source": row[0],
-                                "metadata": json.loads(row[1]),
-                                "cell_type": row[2],
-                                "cell_index": cur_index,
-                            },
-                        }
+                    for cell_id in inserted
+                ],
+            )
+        if len(updated) > 0:
+            await db.executemany(
+                "UPDATE notebook_cells SET source=?,metadata=?,cell_type=? WHERE object_id=? AND cell_id=?;",
+                [
+                    (
+                        cells[cell_id]["source"],
+                        dumps(cells[cell_id]["metadata"]),
+                        cells[cell_id]["cell_type"],
+                        object_id,
+                        cell_id,
                     )
-
-                    # Finally, check if there was an index change, and perform the necessary modifications
-                    if "cell_index" in cell and cell["cell_index"] != cur_index:
-                        target_index = cell["cell_index"]
-                        c = await db.execute(
-                            "SELECT max(cell_index) FROM notebook_cells WHERE object_id=?;",
-                            (object_id,),
-                        )
-                        max_index = (await c.fetchone())[0]
-                        await c.close()
-
-                        if target_index < 0 or target_index > max_index:
-                            target_index = max_index
-
-                        if target_index != cur_index:
-                            if target_index > cur_index:
-                                await db.execute(
-                                    "UPDATE notebook_cells SET cell_index=cell_index-1 WHERE object_id=? AND cell_index >? AND cell_index<=?;",
-                                    (object_id, cur_index, target_index),
-                                )
-                            else:
-                                await db.execute(
-                                    "UPDATE notebook_cells SET cell_index=cell_index+1 WHERE object_id=? AND cell_index >=? AND cell_index<?;",
-                                    (object_id, target_index, cur_index),
-                                )
-                            await db.execute(
-                                "UPDATE notebook_cells SET cell_index=? WHERE object_id=? AND cell_id=?;",
-                                (target_index, object_id, cell_id),
-                            )
-                            # Update the event to include the correct index
-                            event_data[-1]["data"]["cell_index"] = target_index
-
-                    if "outputs" in cell:
-                        event_data.append(
-                            {
-                                "event": "notebook_cell_outputs",
-                                "object": object_id,
-                                "data": {"cell_id": cell_id},
-                            }
-                        )
-        await db.commit()
+                    for cell_id in updated
+                ],
+            )
+        touched -= inserted
+        if len(touched) > 0:
+            await db.executemany(
+                "UPDATE notebook_cells SET version=? WHERE object_id=? AND cell_id=?;",
+                [(version, object_id, cell_id) for cell_id in touched],
+            )
+        moved = order.changed - inserted
+        if len(moved) > 0:
+            await db.executemany(
+                "UPDATE notebook_cells SET cell_index=? WHERE object_id=? AND cell_id=?;",
+                [(order.index[cell_id], object_id, cell_id) for cell_id in moved],
+            )
+        if len(outputs) > 0:
+            await db.executemany(
+                "DELETE FROM notebook_cell_outputs WHERE object_id=? AND cell_id=?;",
+                [
+                    (object_id, cell_id)
+                    for cell_id in outputs
+                    if not cell_id in inserted
+                ],
+            )
+            await db.executemany(
+                "INSERT INTO notebook_cell_outputs (object_id,cell_id,seq,output) VALUES (?,?,?,?);",
+                [
+                    (object_id, cell_id, seq, dumps(o))
+                    for cell_id, cell_outputs in outputs.items()
+                    for seq, o in enumerate(cell_outputs)
+                ],
+            )
+    cache.invalidate(object_id)
 
     # Fires the event, which includes source content (source content is assumed to be relatively small)
     for evt in event_data:
-        await p.fire(evt)
+        events.put(evt)
 
 
-# Explicitly apply the \b character as a backspace on the string
-# https://stackoverflow.com/questions/34362966/python-how-to-apply-backspaces-to-a-string
-# https://stackoverflow.com/questions/14693701/how-can-i-remove-the-ansi-escape-sequences-from-a-string-in-python
-# An example that needs to work: "\x1b[?25h\x08 \x08canceled\r\n" because it shows up when doing %pip install
-# apply_backspace("\x1b[?25h\x08 \x08canceled\r\n")
+# The terminal state of each stream that is currently being written, keyed by (object_id,cell_id,stream name).
+# The values are (TerminalText, index of the stream's output in the cell's outputs array)
+terminals = {}
 
-backspacer = re.compile(r"[^\x08]\x08")
-ansi_codes = re.compile(r"((?:\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~]))+)")
 
+def forget_terminals(object_id, cell_id=None):
+    for k in list(terminals.keys()):
+        if k[0] == object_id and (cell_id is None or k[1] == cell_id):
+            del terminals[k]
 
-def simple_apply_backspace(s):
-    while True:
-        t = backspacer.sub("", s)
-        if not "\b" in t:
-            return t
-        if len(s) == len(t):
-            return t
-        s = t
-
-
-def apply_backspace(s):
-    if not "\b" in s:
-        return s
-    # print("HERE IS THE STRING:", repr(s))
-    acs = ansi_codes.split(s)
-    # print(acs)
-    carry = ""
-    for i in range(len(acs) - 1, -1, -2):
-        # print(i, len(acs))
-        v = simple_apply_backspace(acs[i] + carry)
-        acs[i] = v.lstrip("\b")
-        carry = v[: len(v) - len(acs[i])]
-        # print("acs", repr(acs[i]), (carry))
-
-    return "".join(acs)
-
-
-# Test the following:
-# apply_backspace("\x1b[?25h\x08 \x08canceled\r\n")
-
-
-def fixlines(fulltext):
-    # Stdout output can include backspaces \b and carriage returns \r, which we want to explicitly act on the string.
-
-    # Fix carriage returns
-    lines = fulltext.splitlines(True)
-    newlines = []
-    for i in range(len(lines) - 1):
-        if lines[i][-1] != "\r":
-            newlines.append(apply_backspace(lines[i]))
-    return "".join(newlines) + apply_backspace(lines[-1])
-
-
-async def notebook_cell_outputs(object_id, cell_id, data):
-    l.debug(f"Updating outputs for {object_id}/{cell_id}")
-
-    async with connect_to_database() as db:
-        await db.execute("PRAGMA foreign_keys=1")
-
-        # if the output type is stdout or stderr, append directly to the original values, since many things use terminal sequences
-        updated = False
-        if "output_type" in data and data["output_type"] == "stream":
-            rows = list(
-                await db.execute_fetchall(
-                    "SELECT json_each.key AS k, json_extract(json_each.value,'$.text') AS v FROM notebook_cells, json_each(outputs) WHERE json_extract(json_each.value,'$.output_type')='stream' AND json_extract(json_each.value,'$.name')=? AND object_id=? AND cell_id=?",
-                    (data["name"], object_id, cell_id),
-                )
+
+async def append_cell_output(db, object_id, cell_id, data):
+    # Returns the change that was made to the cell's outputs, which is either a new output appended at seq,
+    # or the text of the stream output at seq being replaced from index start onwards. Returns None if the cell doesn't exist.
+    # if the output type is stdout or stderr, append directly to the original values, since many things use terminal sequences
+    if "output_type" in data and data["output_type"] == "stream":
+        key = (object_id, cell_id, data["name"])
+        if key not in terminals:
+            rows = await db.execute_fetchall(
+                "SELECT seq,json_extract(output,'$.text') FROM notebook_cell_outputs WHERE object_id=? AND cell_id=? AND json_extract(output,'$.output_type')='stream' AND json_extract(output,'$.name')=? ORDER BY seq ASC LIMIT 1;",
+                (object_id, cell_id, data["name"]),
             )
             if len(rows) > 0:
-                fulltext = fixlines(rows[0][1] + data["text"])
-                # There can be \r replacing previous lines, so correct for that
-                await db.execute(
-                    f"UPDATE notebook_cells SET outputs=json_replace(outputs,'$[{rows[0][0]}].text',json(?)) WHERE object_id=? AND cell_id=?;",
-                    (json.dumps(fulltext), object_id, cell_id),
-                )
-                updated = True
-            else:
-                data["text"] = fixlines(data["text"])
-        if not updated:
+                terminals[key] = (TerminalText(rows[0][1]), rows[0][0])
+        if key in terminals:
+            t, seq = terminals[key]
+            # There can be \r replacing previous lines, so only the text after start is rewritten
+            start, text = await workers.run_thread(
+                len(data["text"]), t.write, data["text"]
+            )
             await db.execute(
-                "UPDATE notebook_cells SET outputs=json_insert(outputs,'$[' || json_array_length(outputs) || ']',json(?)) WHERE object_id=? AND cell_id=?;",
-                (json.dumps(data), object_id, cell_id),
+                "UPDATE notebook_cell_outputs SET output=json_set(output,'$.text',substr(json_extract(output,'$.text'),1,?) || ?) WHERE object_id=? AND cell_id=? AND seq=?;",
+                (start, text, object_id, cell_id, seq),
             )
-        await db.commit()
+            return {"op": "stream", "seq": seq, "start": start, "text": text}
+        t = TerminalText()
+        _, data["text"] = await workers.run_thread(
+            len(data["text"]), t.write, data["text"]
+        )
 
-    await p.fire(
-        {
-            "event": "notebook_cell_outputs",
-            "object": object_id,
-            "data": {"cell_id": cell_id},
-        }
+    rows = await db.execute_fetchall(
+        "SELECT COALESCE(max(seq)+1,0) FROM notebook_cell_outputs WHERE object_id=? AND cell_id=?;",
+        (object_id, cell_id),
+    )
+    seq = rows[0][0]
+    # The output is only inserted if the cell still exists
+    c = await db.execute(
+        "INSERT INTO notebook_cell_outputs (object_id,cell_id,seq,output) SELECT object_id,cell_id,?,? FROM notebook_cells WHERE object_id=? AND cell_id=?;",
+        (seq, await workers.run(output_size(data), dumps, data), object_id, cell_id),
     )
+    inserted = c.rowcount > 0
+    await c.close()
+    if not inserted:
+        return None
+    if data.get("output_type") == "stream":
+        terminals[key] = (t, seq)
+    return {"op": "append", "seq": seq, "output": data}
+
+
+def op_size(op):
+    if op["op"] == "stream":
+        return len(op["text"]) + 64
+    return output_size(op["output"])
+
+
+async def notebook_cell_outputs(cell_outputs):
+    # cell_outputs maps (object_id,cell_id) to the array of outputs to append to the cell,
+    # all of which are written in a single transaction. Each notebook is written in its own savepoint,
+    # so that a failure in one notebook doesn't lose the outputs of the others.
+    l.debug(f"Updating outputs for {len(cell_outputs)} cells")
+    for outputs in cell_outputs.values():
+        await externalize_outputs(outputs)
+
+    notebooks = {}
+    for (object_id, cell_id) in cell_outputs:
+        notebooks.setdefault(object_id, []).append(cell_id)
+
+    versions = {}
+    base_versions = {}
+    ops = {}
+    try:
+        async with database.write() as db:
+            for object_id, cell_ids in notebooks.items():
+                try:
+                    async with database.savepoint(db):
+                        for cell_id in cell_ids:
+                            rows = await db.execute_fetchall(
+                                "SELECT version FROM notebook_cells WHERE object_id=? AND cell_id=?;",
+                                (object_id, cell_id),
+                            )
+                            if len(rows) > 0:
+                                base_versions[(object_id, cell_id)] = rows[0][0]
+                            cell_ops = [
+                                await append_cell_output(db, object_id, cell_id, data)
+                                for data in cell_outputs[(object_id, cell_id)]
+                            ]
+                            # Outputs of cells that don't exist, such as those of the kernel initialization code, are not written
+                            cell_ops = [op for op in cell_ops if op is not None]
+                            if len(cell_ops) > 0:
+                                ops[(object_id, cell_id)] = cell_ops
+                        changed = [
+                            cell_id
+                            for cell_id in cell_ids
+                            if (object_id, cell_id) in ops
+                        ]
+                        if len(changed) == 0:
+                            continue
+                        version = await bump_version(db, object_id)
+                        # Outputs of deleted notebooks were not written
+                        if version is None:
+                            continue
+                        await db.executemany(
+                            "UPDATE notebook_cells SET version=? WHERE object_id=? AND cell_id=?;",
+                            [(version, object_id, cell_id) for cell_id in changed],
+                        )
+                        versions[object_id] = version
+                except Exception:
+                    l.exception(f"Failed to write outputs of notebook {object_id}")
+                    # The notebook's terminals hold text that was rolled back, so they are read again from the database
+                    forget_terminals(object_id)
+    except Exception:
+        for object_id in notebooks:
+            forget_terminals(object_id)
+        raise
+    written = [k for k in ops if k[0] in versions]
+    for (object_id, cell_id) in written:
+        cache.invalidate(
+            object_id, [(object_id, "notebook"), (object_id, "cell", cell_id)]
+        )
 
+    for (object_id, cell_id) in written:
+        data = {"cell_id": cell_id, "version": versions[object_id]}
+        # Small changes are sent in the event itself, so that clients holding the cell at base_version
+        # can apply them without reading the cell. Otherwise, clients read the cell.
+        cell_ops = ops[(object_id, cell_id)]
+        if (object_id, cell_id) in base_versions and sum(
+            op_size(op) for op in cell_ops
+        ) <= event_delta_size:
+            data["base_version"] = base_versions[(object_id, cell_id)]
+            data["ops"] = cell_ops
+        events.put(
+            {
+                "event": "notebook_cell_outputs",
+                "object": object_id,
+                "data": data,
+            }
+        )
 
-async def notebook_cell_output_clear(object_id, cell_id):
-    l.debug(f"Clearing outputs for {object_id}/{cell_id}")
 
-    async with connect_to_database() as db:
-        await db.execute("PRAGMA foreign_keys=1")
-        await db.execute(
-            "UPDATE notebook_cells SET outputs='[]' WHERE object_id=? AND cell_id=?;",
-            (object_id, cell_id),
+output_buffer = OutputBuffer(
+    notebook_cell_outputs,
+    flush_interval=settings.get("output_flush_interval", 0.1),
+    max_size=settings.get("output_flush_size", 65536),
+)
+# The largest total size of outputs sent within a notebook_cell_outputs event
+event_delta_size = settings.get("event_delta_size", 16384)
+
+
+async def clear_outputs(object_id, cell_ids):
+    # Clears the outputs of the given cells in a single transaction, and returns the notebook's new version,
+    # or None if the notebook no longer exists
+    l.debug(f"Clearing outputs for {len(cell_ids)} cells of {object_id}")
+    for cell_id in cell_ids:
+        # Outputs that were not yet written belong to the previous run of the cell
+        await output_buffer.discard(object_id, cell_id)
+        forget_terminals(object_id, cell_id)
+
+    async with database.write() as db:
+        await db.executemany(
+            "DELETE FROM notebook_cell_outputs WHERE object_id=? AND cell_id=?;",
+            [(object_id, cell_id) for cell_id in cell_ids],
+        )
+        version = await bump_version(db, object_id)
+        if version is None:
+            return None
+        await db.executemany(
+            "UPDATE notebook_cells SET version=? WHERE object_id=? AND cell_id=?;",
+            [(version, object_id, cell_id) for cell_id in cell_ids],
         )
-        await db.commit()
+    cache.invalidate(
+        object_id,
+        [(object_id, "notebook")]
+        + [(object_id, "cell", cell_id) for cell_id in cell_ids],
+    )
+    return version
 
-    await p.fire(
+
+async def notebook_cell_output_clear(object_id, cell_id):
+    version = await clear_outputs(object_id, [cell_id])
+    if version is None:
+        return
+    events.put(
         {
             "event": "notebook_cell_outputs",
             "object": object_id,
-            "data": {"cell_id": cell_id, "outputs": []},
+            "data": {"cell_id": cell_id, "outputs": [], "version": version},
         }
     )
 
 
+def row_size(row):
+    # The approximate memory used by a row of cell columns
+    return sum(len(v) for v in row if isinstance(v, str)) + 64
+
+
+def cell_dict(row):
+    # Parses a row of all cell columns
+    cell = dict(zip(cell_columns.keys(), row))
+    cell["outputs"] = loads(cell["outputs"])
+    cell["metadata"] = loads(cell["metadata"])
+    return cell
+
+
+async def read_notebook_version(db, object_id):
+    rows = await db.execute_fetchall(
+        "SELECT version FROM notebook_versions WHERE object_id=?;", (object_id,)
+    )
+    return rows[0][0] if len(rows) > 0 else 0
+
+
 async def read_notebook(object_id):
-    l.debug(f"Reading notebook {object_id}")
-    notebook = []
-    async with connect_to_database() as db:
-        await db.execute("PRAGMA foreign_keys=1")
-        # First, get the max index
-        async with db.execute(
-            "SELECT cell_id,cell_index,source,outputs,metadata,cell_type FROM notebook_cells WHERE object_id=? ORDER BY cell_index ASC;",
-            (object_id,),
-        ) as cursor:
-            async for row in cursor:
-                notebook.append(
-                    {
-                        "cell_id": row[0],
-                        "cell_index": row[1],
-                        "source": row[2],
-                        "outputs": json.loads(row[3]),
-                        "metadata": json.loads(row[4]),
-                        "cell_type": row[5],
-                    }
+    # Returns the notebook's version, and the rows of all columns of its cells in order at that version.
+    # Cells are read in pages of notebook_page_size, with the connection returned to the pool between pages,
+    # so that reading a large notebook doesn't hold up other reads. Every write bumps the version, so if it is
+    # the same after the last page, no page saw a change. Otherwise the read is retried, and if the notebook
+    # keeps changing, it is read in a single snapshot.
+    columns = ",".join(
+        "NULL" if f == "cell_index" else c for f, c in cell_columns.items()
+    )
+    query = f"SELECT {columns},c.cell_index FROM notebook_cells c WHERE object_id=? AND (cell_index,cell_id)>(?,?) ORDER BY cell_index ASC,cell_id ASC LIMIT ?;"
+    # The position of the last cell read is (cell_index, cell_id), in case indexes are not unique
+    first = (-(2**63), "")
+
+    def numbered(rows):
+        return [
+            (row[0], cell_index) + tuple(row[2:-1])
+            for cell_index, row in enumerate(rows)
+        ]
+
+    for _ in range(notebook_read_attempts):
+        async with database.read() as db:
+            version = await read_notebook_version(db, object_id)
+        rows = []
+        last = first
+        while True:
+            async with database.read() as db:
+                page = await db.execute_fetchall(
+                    query, (object_id, *last, notebook_page_size)
                 )
-    return notebook
+            rows.extend(page)
+            if len(page) < notebook_page_size:
+                break
+            last = (page[-1][-1], page[-1][0])
+        async with database.read() as db:
+            if await read_notebook_version(db, object_id) == version:
+                return version, numbered(rows)
+
+    l.debug(f"Notebook {object_id} changed while reading, reading it in a snapshot")
+    async with database.read(snapshot=True) as db:
+        version = await read_notebook_version(db, object_id)
+        rows = await db.execute_fetchall(query, (object_id, *first, -1))
+    return version, numbered(rows)
+
+
+async def notebook_rows(object_id):
+    # Yields the notebook's version, followed by the rows of all columns of its cells in order, from the cache when possible.
+    # The whole notebook is read before yielding, so that slow downloads don't hold a database connection.
+    # The rows are cached unless they are too large.
+    key = (object_id, "notebook")
+    cached = cache.get(key)
+    if cached is None:
+        token = cache.token()
+        version, rows = await read_notebook(object_id)
+        size = sum(row_size(row) for row in rows)
+        if size <= cache.max_size:
+            cache.put(key, (version, rows), size, token)
+    else:
+        version, rows = cached
+    yield version
+    for row in rows:
+        yield row
+
+
+async def cell_row(object_id, cell_id):
+    # Returns the row of all columns of the cell, or None if it doesn't exist
+    key = (object_id, "cell", cell_id)
+    row = cache.get(key)
+    if row is not None:
+        return row
+
+    token = cache.token()
+    async with database.read() as db:
+        rows = await db.execute_fetchall(
+            f"SELECT {','.join(cell_columns.values())} FROM notebook_cells c WHERE object_id=? AND cell_id=?",
+            (object_id, cell_id),
+        )
+    if len(rows) == 0:
+        return None
+    row = tuple(rows[0])
+    cache.put(key, row, row_size(row), token)
+    return row
 
 
 async def read_cell(object_id, cell_id):
     l.debug(f"Reading cell {object_id}/{cell_id}")
-    async with connect_to_database() as db:
-        await db.execute("PRAGMA foreign_keys=1")
-        # First, get the max index
-        async with db.execute(
-            "SELECT cell_id,cell_index,source,outputs,metadata,cell_type FROM notebook_cells WHERE object_id=? AND cell_id=?",
-            (object_id, cell_id),
-        ) as cursor:
-            async for row in cursor:
-                return {
-                    "cell_id": row[0],
-                    "cell_index": row[1],
-                    "source": row[2],
-                    "outputs": json.loads(row[3]),
-                    "metadata": json.loads(row[4]),
-                    "cell_type": row[5],
-                }
+    row = await cell_row(object_id, cell_id)
+    if row is None:
+        return None
+    return cell_dict(row)
+
+
+def cell_fields(request):
+    # The fields query parameter is a comma-separated list of the cell fields to return.
+    # Returns None if an unknown field was requested.
+    if not "fields" in request.rel_url.query:
+        return list(cell_columns.keys())
+    fields = [f for f in request.rel_url.query["fields"].split(",") if f != ""]
+    for f in fields:
+        if not f in cell_columns:
+            return None
+    return fields
+
+
+def cell_json(fields, row):
+    # Builds the JSON of the given fields of a cell from a row of all its columns
+    cell = dict(zip(cell_columns.keys(), row))
+    return (
+        "{"
+        + ",".join(
+            f'"{f}":{cell[f] if f in json_columns else dumps(cell[f])}' for f in fields
+        )
+        + "}"
+    )
 
 
-async def kernel_state_update(object_id, state):
-    try:
-        # Trying to update state for an object that was deleted fails
-        await p.fire(
-            {
-                "event": "notebook_kernel_state",
-                "object": object_id,
-                "data": {"state": state},
+async def write_chunks(response, parts, chunk_size=65536):
+    # Writes the strings from the async iterable parts to the response, grouped into chunks of about chunk_size
+    chunk = []
+    size = 0
+    async for part in parts:
+        chunk.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            await response.write("".join(chunk).encode("utf-8"))
+            chunk = []
+            size = 0
+    if len(chunk) > 0:
+        await response.write("".join(chunk).encode("utf-8"))
+
+
+async def notebook_json(rows, fields):
+    # Yields the JSON array of the cells from notebook_rows, one cell at a time
+    yield "["
+    async for row in rows:
+        cj = cell_json(fields, row)
+        yield cj if row[1] == 0 else "," + cj
+    yield "]"
+
+
+def strip_image_data(output):
+    # Returns a copy of the output without images and pdfs
+    output = dict(output)
+    for k in ["data", "blobs"]:
+        if k in output:
+            output[k] = {
+                mimetype: v
+                for mimetype, v in output[k].items()
+                if not mimetype.startswith("image/") and mimetype != "application/pdf"
             }
-        )
-    except:
-        pass
+    return output
+
+
+async def ipynb_json(rows, strip_outputs=False, strip_images=False):
+    # Yields the nbformat document of the cells from notebook_rows, one cell at a time
+    header = dumps(
+        {
+            "metadata": {
+                "kernel_info": {"name": "python3"},
+                "language_info": {
+                    "name": "python",
+                    "mimetype": "text/x-python",
+                    "codemirror_mode": {"name": "ipython", "version": 3},
+                    "version": "3.7.3",
+                },
+            },
+            "nbformat": 4,
+            "nbformat_minor": 0,
+        }
+    )
+    yield header[:-1] + ',"cells":['
+    yield dumps(
+        {
+            "cell_type": "code",
+            "execution_count": None,
+            "metadata": {"collapsed": True},
+            "source": manager.kernel_init_code,
+            "outputs": [],
+        }
+    )
+
+    async for row in rows:
+        c = dict(zip(cell_columns.keys(), row))
+        curcell = {
+            "cell_type": c["cell_type"],
+            "execution_count": None,
+            "metadata": {},
+            "source": c["source"],
+        }
+        if c["cell_type"] == "code":
+            metadata = loads(c["metadata"])
+            curcell["metadata"] = {
+                "collapsed": False
+                if not "collapsed" in metadata
+                else metadata["collapsed"],
+                "scrolled": False
+                if not "scrolled" in metadata
+                else metadata["scrolled"],
+            }
+            if strip_outputs:
+                curcell["outputs"] = []
+            elif not strip_images and not '"blobs"' in c["outputs"]:
+                # Outputs that don't reference blobs are written as they are stored
+                yield "," + dumps(curcell)[:-1] + ',"outputs":' + c["outputs"] + "}"
+                continue
+            else:
+                outputs = await workers.run(len(c["outputs"]), loads, c["outputs"])
+                if strip_images:
+                    outputs = [strip_image_data(o) for o in outputs]
+                curcell["outputs"] = await internalize_outputs(outputs)
+                size = sum(output_size(o) for o in curcell["outputs"])
+                yield "," + await workers.run(size, dumps, curcell)
+                continue
+        yield "," + dumps(curcell)
+    yield "]}"
+
+
+def not_modified(request, etag):
+    # Whether the request's If-None-Match header matches the etag
+    if not "If-None-Match" in request.headers:
+        return False
+    tags = [t.strip() for t in request.headers["If-None-Match"].split(",")]
+    return "*" in tags or etag in tags or "W/" + etag in tags
+
+
+async def kernel_state_update(object_id, state):
+    if state == "off":
+        # The kernel's remaining outputs are written before its streams are forgotten. Failures are only logged,
+        # since this runs while the kernel is closed, which must not stop it from being shut down.
+        try:
+            await output_buffer.flush()
+        except Exception:
+            l.exception(f"Failed to write the outputs of {object_id}")
+        forget_terminals(object_id)
+    events.put(
+        {
+            "event": "notebook_kernel_state",
+            "object": object_id,
+            "data": {"state": state},
+        }
+    )
 
 
 async def update_modified_date(r):
@@ -481,15 +1026,78 @@ async def update_modified_date(r):
 
 
 async def kernel_cell_output(object_id, cell_id, data):
-    await notebook_cell_outputs(object_id, cell_id, data)
+    if object_id is None:
+        # Outputs of pooled kernels, which belong to no notebook
+        return
+    await output_buffer.append(object_id, cell_id, data)
+
+
+# The batch run currently in progress in each notebook, keyed by object id
+runs = {}
+
+
+async def kernel_cell_executed(object_id, cell_id, status):
+    run = runs.get(object_id)
+    if run is None or not cell_id in run["cells"]:
+        return
+    run["cells"].discard(cell_id)
+    run["done"] += 1
+    if status != "ok":
+        run["failed"] += 1
+    if len(run["cells"]) == 0:
+        del runs[object_id]
+        run["finished"].set()
+    # Consecutive progress events are merged by the dispatcher, so clients get the latest counts
+    events.put(
+        {
+            "event": "notebook_run_progress",
+            "object": object_id,
+            "data": {
+                "run_id": run["run_id"],
+                "total": run["total"],
+                "done": run["done"],
+                "failed": run["failed"],
+            },
+        }
+    )
+
+
+async def kernel_limit_exceeded(object_id, data):
+    events.put({"event": "notebook_kernel_limit", "object": object_id, "data": data})
 
 
+resource_limits = ResourceLimits(
+    kernel_memory=settings.get("kernel_memory_limit", 0),
+    user_memory=settings.get("user_memory_limit", 0),
+    cpu_weight=settings.get("kernel_cpu_weight", 0),
+    address_space=settings.get("kernel_address_space_limit", 0),
+    cgroup_root=settings.get("cgroup_root", None),
+)
+
 m = manager.Manager(
     p,
     config_file,
     ipy_config,
     kernelStateChange=kernel_state_update,
     kernelOutput=kernel_cell_output,
+    kernelExecuted=kernel_cell_executed,
+    kernelLimit=kernel_limit_exceeded,
+    kernel_pool_size=settings.get("kernel_pool_size", 0),
+    kernel_pool_max=settings.get("kernel_pool_max", 8),
+    kernel_pool_min_memory=settings.get("kernel_pool_min_memory", 1024),
+    kernel_idle_timeout=settings.get("kernel_idle_timeout", 2 * 60 * 60),
+    server_idle_timeout=settings.get("server_idle_timeout", 15 * 60),
+    server_start_timeout=settings.get("server_start_timeout", 60),
+    max_kernels=settings.get("max_kernels", 0),
+    max_servers=settings.get("max_servers", 0),
+    kernel_backend=settings.get("kernel_backend", "server"),
+    kernel_message_history=settings.get("kernel_message_history", 0),
+    kernel_message_sample=settings.get("kernel_message_sample", 1),
+    kernel_message_decode=lambda md: workers.run(len(md), loads, md),
+    kernel_max_in_flight=settings.get("kernel_max_in_flight", 1),
+    max_user_kernels=settings.get("max_user_kernels", 0),
+    resource_limits=resource_limits,
+    resource_interval=settings.get("resource_interval", 5),
 )
 
 
@@ -498,7 +1106,30 @@ async def notebook(request):
     if not p.hasAccess(request, "read"):
         return web.Response(status=403, body="Not permitted")
     r = p.objectRequest(request)
-    return web.json_response(await read_notebook(r["object"]))
+    fields = cell_fields(request)
+    if fields is None:
+        return web.Response(status=400, body="Unknown cell field")
+
+    l.debug(f"Reading notebook {r['object']}")
+    rows = notebook_rows(r["object"])
+    try:
+        etag = f'"{await rows.__anext__()}"'
+        if not_modified(request, etag):
+            return web.Response(status=304, headers={"ETag": etag})
+        response = web.StreamResponse(
+            headers={
+                "Content-Type": "application/json",
+                "ETag": etag,
+                "Cache-Control": "private, no-cache",
+            }
+        )
+        await response.prepare(request)
+        await write_chunks(response, notebook_json(rows, fields))
+    finally:
+        # Returns the database connection right away if the client disconnected
+        await rows.aclose()
+    await response.write_eof()
+    return response
 
 
 @routes.post("/notebook")
@@ -506,7 +1137,8 @@ async def update_notebook(request):
     if not p.hasAccess(request, "write"):
         return web.Response(status=403, body="Not permitted")
     r = p.objectRequest(request)
-    data = await request.json()
+    body = await request.text()
+    data = await workers.run(len(body), loads, body)
     for d in data:
         if "outputs" in d and len(d["outputs"]) > 0:
             return web.Response(
@@ -527,88 +1159,114 @@ async def ipynb_get(request):
         return web.Response(status=403, body="Not permitted")
 
     r = p.objectRequest(request)
-    heedy_nb = await read_notebook(r["object"])
+    # strip_outputs and strip_images leave out all outputs or only images, and gzip compresses the response
+    query = request.rel_url.query
+    compress = "gzip" in query and "gzip" in request.headers.get("Accept-Encoding", "")
+    rows = notebook_rows(r["object"])
+    try:
+        etag = f'"{await rows.__anext__()}{"-gzip" if compress else ""}"'
+        if not_modified(request, etag):
+            return web.Response(status=304, headers={"ETag": etag})
+        response = web.StreamResponse(
+            headers={
+                "Content-Type": "application/x-ipynb+json",
+                "Content-Disposition": "attachment",
+                "ETag": etag,
+                "Cache-Control": "private, no-cache",
+            }
+        )
+        if compress:
+            response.enable_compression(web.ContentCoding.gzip)
+        await response.prepare(request)
+        await write_chunks(
+            response,
+            ipynb_json(rows, "strip_outputs" in query, "strip_images" in query),
+        )
+    finally:
+        await rows.aclose()
+    await response.write_eof()
+    return response
 
-    cells = [
-        {
-            "cell_type": "code",
-            "execution_count": None,
-            "metadata": {"collapsed": True},
-            "source": manager.kernel_init_code,
-            "outputs": [],
-        }
-    ]
 
-    for c in heedy_nb:
-        cell_metadata = {}
-        curcell = {
-            "cell_type": c["cell_type"],
-            "execution_count": None,
-            "metadata": {},
-            "source": c["source"],
-        }
-        if c["cell_type"] == "code":
-            curcell["metadata"] = {
-                "collapsed": False
-                if not "collapsed" in c["metadata"]
-                else c["metadata"]["collapsed"],
-                "scrolled": False
-                if not "scrolled" in c["metadata"]
-                else c["metadata"]["scrolled"],
-            }
-            curcell["outputs"] = c["outputs"]
-        cells.append(curcell)
-
-    ipython_notebook = {
-        "metadata": {
-            "kernel_info": {"name": "python3"},
-            "language_info": {
-                "name": "python",
-                "mimetype": "text/x-python",
-                "codemirror_mode": {"name": "ipython", "version": 3},
-                "version": "3.7.3",
-            },
-        },
-        "nbformat": 4,
-        "nbformat_minor": 0,
-        "cells": cells,
-    }
-    return web.Response(
-        text=json.dumps(ipython_notebook),
-        content_type="application/x-ipynb+json",
-        headers={"Content-Disposition": "attachment"},
-    )
+import_max_size = settings.get("import_max_size", 256 * 1024 * 1024)
+import_batch_size = settings.get("import_batch_size", 100)
+import_batch_bytes = settings.get("import_batch_bytes", 4 * 1024 * 1024)
 
 
 @routes.post("/notebook.ipynb")
 async def post_ipython(request):
     if not p.hasAccess(request, "write"):
         return web.Response(status=403, body="Not permitted")
+    if request.content_length is not None and request.content_length > import_max_size:
+        return web.Response(status=413, body="Notebook too large")
     r = p.objectRequest(request)
-    data = json.loads((await request.post())["notebook"].file.read())
-    # print(data)
-    if data["metadata"]["language_info"]["name"] != "python":
-        return web.Response(status=400, body="Notebook must be python")
-
-    if len(data["cells"]) > 0:
-        cells = []
-
-        for c in data["cells"]:
-            if isinstance(c["source"], list):
-                c["source"] = "".join(c["source"])
-            cur_cell = {
-                "cell_type": c["cell_type"],
-                "source": c["source"],
-                "metadata": c["metadata"],
-            }
-            if "outputs" in c:
-                cur_cell["outputs"] = c["outputs"]
-            cells.append(cur_cell)
-
-        if "HEEDY NOTEBOOK HEADER" in cells[0]["source"]:
-            # Remove the heedy header
-            cells = cells[1:]
-        await save_notebook_modifications(r["object"], cells)
+    object_id = r["object"]
+
+    reader = await request.multipart()
+    part = await reader.next()
+    while part is not None and part.name != "notebook":
+        await part.release()
+        part = await reader.next()
+    if part is None:
+        return web.Response(status=400, body="No notebook given")
+
+    # The file is parsed as it arrives, and its cells are written in batches, so that neither the file
+    # nor its cells need to be held in memory at once
+    parser = IpynbReader()
+    imported = []
+    batch = []
+    batch_bytes = 0
+    received = 0
+
+    async def fail(status, body):
+        if len(imported) > 0:
+            await save_notebook_modifications(
+                object_id, [{"cell_id": cid, "delete": True} for cid in imported]
+            )
+        return web.Response(status=status, body=body)
+
+    while True:
+        chunk = await part.read_chunk(65536)
+        received += len(chunk)
+        if received > import_max_size:
+            return await fail(413, "Notebook too large")
+        try:
+            cells = await workers.run_thread(len(chunk), parser.feed, chunk)
+        except (ijson.JSONError, KeyError, TypeError, AttributeError):
+            return await fail(400, "Invalid notebook")
+        batch.extend(cells)
+        batch_bytes += len(chunk)
+
+        if parser.language is not None and parser.language != "python":
+            return await fail(400, "Notebook must be python")
+
+        if len(batch) > 0 and (
+            len(chunk) == 0
+            or len(batch) >= import_batch_size
+            or batch_bytes >= import_batch_bytes
+        ):
+            await save_notebook_modifications(object_id, batch)
+            imported.extend(c["cell_id"] for c in batch)
+            batch = []
+            batch_bytes = 0
+            events.put(
+                {
+                    "event": "notebook_import_progress",
+                    "object": object_id,
+                    "data": {
+                        "cells": len(imported),
+                        "bytes": received,
+                        "total": request.content_length,
+                    },
+                }
+            )
+
+        if len(chunk) == 0:
+            break
+
+    if parser.language != "python":
+        return await fail(400, "Notebook must be python")
+    if len(imported) > 0:
         await update_modified_date(r)
 
     return web.json_response("ok")
@@ -619,10 +1277,57 @@ async def get_cell(request):
     if not p.hasAccess(request, "read"):
         return web.Response(status=403, body="Not permitted")
     r = p.objectRequest(request)
+    fields = cell_fields(request)
+    if fields is None:
+        return web.Response(status=400, body="Unknown cell field")
+
+    row = await cell_row(r["object"], request.match_info["cellid"])
+    if row is None:
+        return web.Response(text="null", content_type="application/json")
+
+    # The cell's position is part of the response, and changes without the cell being modified
+    cell = dict(zip(cell_columns.keys(), row))
+    etag = f'"{cell["version"]}.{cell["cell_index"]}"'
+    if not_modified(request, etag):
+        return web.Response(status=304, headers={"ETag": etag})
+    return web.Response(
+        text=cell_json(fields, row),
+        content_type="application/json",
+        headers={"ETag": etag, "Cache-Control": "private, no-cache"},
+    )
 
-    cell_content = await read_cell(r["object"], request.match_info["cellid"])
 
-    return web.json_response(cell_content)
+@routes.get("/notebook/output/{name}")
+async def get_output_blob(request):
+    if not p.hasAccess(request, "read"):
+        return web.Response(status=403, body="Not permitted")
+    r = p.objectRequest(request)
+    name = request.match_info["name"]
+    if blob_name.match(name) is None:
+        return web.Response(status=404, body="Not found")
+
+    # Only blobs referenced by this notebook's outputs can be read
+    async with database.read() as db:
+        rows = await db.execute_fetchall(
+            "SELECT 1 FROM notebook_cell_outputs WHERE object_id=? AND instr(output,?)>0 LIMIT 1;",
+            (r["object"], name),
+        )
+    if len(rows) == 0 or not os.path.exists(blob_store.path(name)):
+        return web.Response(status=404, body="Not found")
+
+    content_type = blob_store.content_type(name)
+    headers = {
+        "Content-Type": content_type,
+        "X-Content-Type-Options": "nosniff",
+        "Cache-Control": "private, max-age=31536000, immutable",
+        "ETag": f'"{name}"',
+    }
+    # Outputs can contain html and svg with scripts, which must not run on heedy's origin when a blob is
+    # opened directly. The frontend only uses blobs as images or fetches their content, which isn't affected.
+    # Browsers don't show PDFs in a sandbox, and their scripts don't run on the page's origin.
+    if content_type != "application/pdf":
+        headers["Content-Security-Policy"] = "sandbox"
+    return web.FileResponse(blob_store.path(name), headers=headers)
 
 
 @routes.post("/notebook/kernel")
@@ -630,7 +1335,7 @@ async def run_cell(request):
     if not p.hasAccess(request, "run"):
         return web.Response(status=403, body="Not permitted")
     r = p.objectRequest(request)
-    data = await request.json()
+    data = await request.json(loads=loads)
     cell_content = await read_cell(r["object"], data["cell_id"])
     # print(cell_content,data["source"])
     if cell_content["source"] != data["source"]:
@@ -639,13 +1344,185 @@ async def run_cell(request):
     if cell_content["cell_type"] == "code":
         src = cell_content["source"]
         l.info(f"RUN {data['cell_id']}")
-        await notebook_cell_output_clear(r["object"], data["cell_id"])
         server = await m.get(r["owner"], notify_oid=r["object"])
-        kernel = await server.kernel(r["object"])
+        try:
+            kernel = await server.kernel(r["object"])
+        except LimitExceeded as e:
+            return web.Response(status=429, body=str(e))
+        await notebook_cell_output_clear(r["object"], data["cell_id"])
         await kernel.run(data["cell_id"], src)
     return web.json_response("ok")
 
 
+@routes.post("/notebook/kernel/run")
+async def run_cells(request):
+    # Runs several cells in order. Either the cells are given as a list of {"cell_id","source"}, whose sources
+    # must match the saved cells, or all cells with index from start up to (not including) end are run.
+    if not p.hasAccess(request, "run"):
+        return web.Response(status=403, body="Not permitted")
+    r = p.objectRequest(request)
+    object_id = r["object"]
+    data = await request.json(loads=loads)
+
+    async with database.read() as db:
+        if "cells" in data:
+            sources = {c["cell_id"]: c["source"] for c in data["cells"]}
+            found = {}
+            for part in chunks(list(sources.keys())):
+                rows = await db.execute_fetchall(
+                    f"SELECT cell_id,source,cell_type FROM notebook_cells WHERE object_id=? AND cell_id IN ({','.join('?' * len(part))});",
+                    (object_id, *part),
+                )
+                found.update((row[0], row) for row in rows)
+            for cell_id, source in sources.items():
+                if not cell_id in found:
+                    return web.Response(status=400, body=f"Cell {cell_id} not found")
+                if found[cell_id][1] != source:
+                    l.error("Cell source does not match")
+                    return web.Response(status=403, body="Source does not match")
+            rows = [found[cell_id] for cell_id in sources]
+        else:
+            start = data.get("start", 0)
+            end = data.get("end", None)
+            rows = await db.execute_fetchall(
+                "SELECT cell_id,source,cell_type FROM notebook_cells WHERE object_id=? ORDER BY cell_index ASC LIMIT ? OFFSET ?;",
+                (object_id, -1 if end is None else max(0, end - start), start),
+            )
+    cells = [(row[0], row[1]) for row in rows if row[2] == "code"]
+    if len(cells) == 0:
+        return web.json_response({"run_id": None, "cells": []})
+
+    try:
+        run = await start_run(r["owner"], object_id, cells)
+    except LimitExceeded as e:
+        return web.Response(status=429, body=str(e))
+    return web.json_response(
+        {"run_id": run["run_id"], "cells": [cell_id for cell_id, _ in cells]}
+    )
+
+
+async def start_run(owner, object_id, cells):
+    # Clears the outputs of the given (cell_id, source) code cells, and queues them in the notebook's kernel.
+    # Returns the run, whose finished event is set once all of its cells finished. The kernel is started first,
+    # so that nothing is cleared if it can't be started.
+    server = await m.get(owner, notify_oid=object_id)
+    kernel = await server.kernel(object_id)
+
+    cell_ids = [cell_id for cell_id, _ in cells]
+    l.info(f"RUN {len(cells)} cells of {object_id}")
+    version = await clear_outputs(object_id, cell_ids)
+    if object_id in runs:
+        # The previous run is no longer tracked
+        runs[object_id]["finished"].set()
+    run_id = uuid.uuid4().hex
+    run = {
+        "run_id": run_id,
+        "cells": set(cell_ids),
+        "total": len(cells),
+        "done": 0,
+        "failed": 0,
+        "finished": asyncio.Event(),
+    }
+    runs[object_id] = run
+    # A single event tells clients which cells were cleared and queued, instead of an event for each cell
+    events.put(
+        {
+            "event": "notebook_run_progress",
+            "object": object_id,
+            "data": {
+                "run_id": run_id,
+                "cells": cell_ids,
+                "version": version,
+                "total": len(cells),
+                "done": 0,
+                "failed": 0,
+            },
+        }
+    )
+
+    for cell_id, source in cells:
+        await kernel.run(cell_id, source)
+    return run
+
+
+async def run_notebook(object_id, owner):
+    # Runs all code cells of the notebook from top to bottom without a client. The kernel is shut down afterwards
+    # to free its memory, unless it was already running before.
+    async with database.read() as db:
+        cells = await db.execute_fetchall(
+            "SELECT cell_id,source FROM notebook_cells WHERE object_id=? AND cell_type='code' ORDER BY cell_index ASC;",
+            (object_id,),
+        )
+    if len(cells) == 0:
+        return "ok"
+    server = await m.get(owner)
+    was_running = object_id in server.kernels
+    run = await start_run(owner, object_id, cells)
+    try:
+        await asyncio.wait_for(run["finished"].wait(), schedule_timeout)
+        status = "ok" if run["failed"] == 0 else "error"
+    except asyncio.TimeoutError:
+        status = "timeout"
+        if was_running:
+            await server.interrupt_kernel(object_id)
+    if not was_running:
+        await m.close_kernel(owner, object_id)
+    return status
+
+
+scheduler = Scheduler(
+    database,
+    run_notebook,
+    concurrency=settings.get("schedule_concurrency", 2),
+    interval=settings.get("schedule_interval", 30),
+)
+# Scheduled runs that take longer than this many seconds are stopped
+schedule_timeout = settings.get("schedule_timeout", 60 * 60)
+
+
+@routes.get("/notebook/schedule")
+async def get_schedule(request):
+    if not p.hasAccess(request, "read"):
+        return web.Response(status=403, body="Not permitted")
+    r = p.objectRequest(request)
+    return web.json_response(await scheduler.get(r["object"]))
+
+
+@routes.post("/notebook/schedule")
+async def set_schedule(request):
+    if not p.hasAccess(request, "write") or not p.hasAccess(request, "run"):
+        return web.Response(status=403, body="Not permitted")
+    r = p.objectRequest(request)
+    data = await request.json(loads=loads)
+    try:
+        await scheduler.set(
+            r["object"], r["owner"], data["cron"], data.get("enabled", True)
+        )
+    except ValueError as e:
+        return web.Response(status=400, body=str(e))
+    return web.json_response(await scheduler.get(r["object"]))
+
+
+@routes.delete("/notebook/schedule")
+async def delete_schedule(request):
+    if not p.hasAccess(request, "write"):
+        return web.Response(status=403, body="Not permitted")
+    r = p.objectRequest(request)
+    await scheduler.delete(r["object"])
+    return web.json_response("ok")
+
+
+@routes.post("/notebook/schedule/run")
+async def run_scheduled(request):
+    # Runs the notebook in the background now, as if it were scheduled
+    if not p.hasAccess(request, "run"):
+        return web.Response(status=403, body="Not permitted")
+    r = p.objectRequest(request)
+    if not scheduler.start(r["object"], r["owner"]):
+        return web.Response(status=400, body="Notebook is already running")
+    return web.json_response("ok")
+
+
 @routes.delete("/notebook/kernel")
 async def close_kernel(request):
     if not p.hasAccess(request, "run"):
@@ -678,7 +1555,10 @@ async def kernel_state(request):
 
     if "start" in request.rel_url.query:
         server = await m.get(r["owner"], notify_oid=r["object"])
-        kernel = await server.kernel(r["object"])
+        try:
+            kernel = await server.kernel(r["object"])
+        except LimitExceeded as e:
+            return web.Response(status=429, body=str(e))
 
         return web.json_response(kernel.state)
 
@@ -688,17 +1568,94 @@ async def kernel_state(request):
     return web.json_response(await server.state(r["object"]))
 
 
+@routes.get("/notebook/kernel/messages")
+async def kernel_messages(request):
+    if not p.hasAccess(request, "run"):
+        return web.Response(status=403, body="Not permitted")
+
+    r = p.objectRequest(request)
+    if not r["owner"] in m.servers:
+        return web.json_response([])
+    server = await m.get(r["owner"])
+    # Message headers can contain datetimes, which are sent as strings
+    return web.json_response(
+        server.messages(r["object"]), dumps=lambda x: dumps(x, default=str)
+    )
+
+
+@routes.get("/notebook/kernel/queue")
+async def kernel_queue(request):
+    if not p.hasAccess(request, "run"):
+        return web.Response(status=403, body="Not permitted")
+
+    r = p.objectRequest(request)
+    if not r["owner"] in m.servers:
+        return web.json_response({"running": [], "queued": [], "finished": []})
+    server = await m.get(r["owner"])
+    return web.json_response(server.queue(r["object"]))
+
+
+@routes.delete("/notebook/kernel/queue/{cellid}")
+async def cancel_cell(request):
+    if not p.hasAccess(request, "run"):
+        return web.Response(status=403, body="Not permitted")
+
+    r = p.objectRequest(request)
+    if not r["owner"] in m.servers:
+        return web.Response(status=400, body="Cell is not queued")
+    server = await m.get(r["owner"])
+    if not await server.cancel(r["object"], request.match_info["cellid"]):
+        return web.Response(status=400, body="Cell is not queued")
+    return web.json_response("ok")
+
+
+@routes.get("/notebook/kernel/resources")
+async def kernel_resources(request):
+    if not p.hasAccess(request, "run"):
+        return web.Response(status=403, body="Not permitted")
+
+    r = p.objectRequest(request)
+    return web.json_response(m.usage(r["owner"], r["object"]))
+
+
+def is_admin(request):
+    # Whether the request was made by heedy itself, or directly by one of heedy's admin users (not through an app)
+    who = request.headers["X-Heedy-As"]
+    return who == "heedy" or (
+        p.isUser(request) and who in p.config["config"].get("admin_users", [])
+    )
+
+
+@routes.get("/notebook/stats")
+async def stats(request):
+    # The statistics cover all users of the plugin, so they are only shown to admins
+    if not p.hasAccess(request, "read") or not is_admin(request):
+        return web.Response(status=403, body="Not permitted")
+    return web.json_response(
+        {
+            "cache": cache.stats(),
+            "workers": workers.stats(),
+            "loop": loop_monitor.stats(),
+            "events": events.stats(),
+            "servers": m.stats(),
+        }
+    )
+
+
 @routes.post("/notebook_delete")
 async def notebook_deleted(request):
-    evt = await request.json()
+    evt = await request.json(loads=loads)
     l.debug(f"Notebook Deleted: {evt}")
     asyncio.create_task(m.close_kernel(evt["user"], evt["object"]))
+    asyncio.create_task(output_buffer.discard(evt["object"]))
+    forget_terminals(evt["object"])
+    cache.invalidate(evt["object"])
     return web.Response(text="ok")
 
 
 @routes.post("/user_delete")
 async def notebook_deleted_user(request):
-    evt = await request.json()
+    evt = await request.json(loads=loads)
     l.debug(f"User Deleted: {evt}")
     asyncio.create_task(m.close_server(evt["user"]))
     return web.Response(text="ok")
@@ -713,28 +1670,43 @@ async def shutdown():
     await app.shutdown()
     await app.cleanup()
     await m.close()
+    await output_buffer.flush()
+    await events.flush()
+    await database.close()
+    workers.close()
     l.info("Closed")
     asyncio.get_event_loop().stop()
 
 
+async def collect_blobs():
+    # Periodically removes blobs that are no longer referenced by any output
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            async with database.read() as db:
+                rows = await db.execute_fetchall(
+                    "SELECT DISTINCT json_each.value FROM notebook_cell_outputs, json_each(output,'$.blobs');"
+                )
+            await loop.run_in_executor(
+                None, blob_store.collect, set(row[0] for row in rows)
+            )
+        except Exception:
+            l.exception("Failed to remove unreferenced blobs")
+        await asyncio.sleep(settings.get("blob_collect_interval", 24 * 60 * 60))
+
+
 async def runme():
     loop = asyncio.get_event_loop()
     signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
     for sig in signals:
         loop.add_signal_handler(sig, lambda sig=sig: asyncio.create_task(shutdown()))
 
-    # Make sure the notebook cells table exists
-    async with connect_to_database() as db:
-        await db.execute("PRAGMA foreign_keys=1")
-        hastable = True
-        async with db.execute(
-            "SELECT name FROM sqlite_master WHERE type='table' AND name='notebook_cells';"
-        ) as cursor:
-            if await cursor.fetchone() is None:
-                hastable = False
-        if not hastable:
-            await db.execute(schema)
-        await db.commit()
+    # Make sure the notebook tables exist and are up to date
+    await database.open()
+    await database.migrate(migrations)
+    asyncio.create_task(collect_blobs())
+    asyncio.create_task(loop_monitor.run())
+    asyncio.create_task(scheduler.loop())
 
     # Runs the server over a unix domain socket. The socket is automatically placed in the data folder,
     # and not the plugin folder.
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+
+
+def output_size(output):
+    # A rough estimate of the size of an output, used only to decide when to flush
+    if output.get("output_type") == "stream":
+        return len(output.get("text", ""))
+    size = 0
+    for v in output.get("data", {}).values():
+        size += len(v) if isinstance(v, (str, list)) else 64
+    for v in output.get("traceback", []):
+        size += len(v)
+    return size + 64
+
+
+class OutputBuffer:
+    """
+    Kernels can emit thousands of small stream messages a second. Rather than writing each one
+    to the database, outputs are buffered per cell, with consecutive chunks of the same stream merged,
+    and the whole buffer is handed to the write function at once after flush_interval seconds,
+    or as soon as max_size bytes are waiting.
+    """
+
+    _log = logging.getLogger("notebook.OutputBuffer")
+
+    def __init__(self, write, flush_interval=0.1, max_size=65536):
+        self.write = write
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+
+        # Maps (object_id, cell_id) to the list of outputs that were not yet written
+        self.pending = {}
+        self.size = 0
+        self.lock = asyncio.Lock()
+        self.timer = None
+
+    async def append(self, object_id, cell_id, output):
+        outputs = self.pending.setdefault((object_id, cell_id), [])
+        if (
+            output.get("output_type") == "stream"
+            and len(outputs) > 0
+            and outputs[-1].get("output_type") == "stream"
+            and outputs[-1].get("name") == output.get("name")
+        ):
+            outputs[-1]["text"] += output["text"]
+        else:
+            outputs.append(output)
+        self.size += output_size(output)
+
+        if self.size >= self.max_size:
+            # Writing directly here slows down the kernel's websocket, which is the backpressure we want.
+            # Errors are only logged, since they would otherwise end the kernel's message loop.
+            await self._try_flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(
+                self.flush_interval, lambda: asyncio.create_task(self._try_flush())
+            )
+
+    async def _try_flush(self):
+        try:
+            await self.flush()
+        except Exception:
+            self._log.exception("Failed to write cell outputs")
+
+    async def flush(self):
+        async with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if len(self.pending) == 0:
+                return
+            pending = self.pending
+            self.pending = {}
+            self.size = 0
+            await self.write(pending)
+
+    async def discard(self, object_id, cell_id=None):
+        # Removes outputs that were not yet written for the given cell, or the entire notebook if no cell_id is given.
+        # Holding the lock guarantees that a flush currently in progress finishes first.
+        async with self.lock:
+            for k in list(self.pending.keys()):
+                if k[0] == object_id and (cell_id is None or k[1] == cell_id):
+                    self.size -= sum(output_size(o) for o in self.pending.pop(k))
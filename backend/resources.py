@@ -0,0 +1,200 @@
+import logging
+import math
+import os
+import resource
+import time
+
+
+class LimitExceeded(Exception):
+    # Raised when a kernel can't be started without going over a limit
+    pass
+
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def read_processes():
+    # Returns {pid: (ppid, cpu seconds, rss bytes)} for all processes, read from /proc
+    processes = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name can contain spaces and parentheses, so the fields are read after its closing parenthesis
+        fields = stat[stat.rfind(")") + 2 :].split()
+        processes[int(name)] = (
+            int(fields[1]),
+            (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+            int(fields[21]) * PAGE_SIZE,
+        )
+    return processes
+
+
+def process_tree(processes, pid):
+    # Returns the pids of the process and all of its descendants that are in processes
+    children = {}
+    for p, (ppid, _, _) in processes.items():
+        children.setdefault(ppid, []).append(p)
+    pids = []
+    todo = [pid]
+    while len(todo) > 0:
+        p = todo.pop()
+        if p in processes:
+            pids.append(p)
+        todo.extend(children.get(p, []))
+    return pids
+
+
+def tree_usage(processes, pid):
+    # Returns the total (cpu seconds, rss bytes) of the process and all of its descendants
+    cpu = 0
+    rss = 0
+    for p in process_tree(processes, pid):
+        cpu += processes[p][1]
+        rss += processes[p][2]
+    return cpu, rss
+
+
+def find_kernel_pid(kernel_id):
+    # Kernels started by a notebook server are given a connection file named after the kernel's id
+    match = f"kernel-{kernel_id}.json".encode()
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/cmdline", "rb") as f:
+                if match in f.read():
+                    return int(name)
+        except OSError:
+            continue
+    return None
+
+
+def cpu_nice(cpu_weight):
+    # The niceness giving about the same share of CPU as the cgroup cpu.weight, where weight 100 is nice 0,
+    # and each step of niceness is about 1.25x less CPU. Only lowering the priority is allowed.
+    return min(19, max(0, round(-math.log(cpu_weight / 100) / math.log(1.25))))
+
+
+class ResourceLimits:
+    """
+    ResourceLimits applies the memory and CPU limits of kernels as soon as their process is started. With cgroups v2, each user gets
+    a cgroup limited to user_memory MB, holding a cgroup for each kernel limited to kernel_memory MB with a CPU share of
+    cpu_weight, below cgroup_root. The plugin must be able to write to cgroup_root (for example, a cgroup delegated by systemd),
+    and cgroup_root must not contain any processes itself.
+
+    Without cgroups, kernels are reniced to get about the same CPU share, and memory limits are enforced by sampling usage.
+    address_space sets RLIMIT_AS for each kernel in MB, which limits virtual memory, so it must be well above the memory limits.
+    A value of 0 disables a limit.
+    """
+
+    _log = logging.getLogger("notebook.ResourceLimits")
+
+    def __init__(
+        self,
+        kernel_memory=0,
+        user_memory=0,
+        cpu_weight=0,
+        address_space=0,
+        cgroup_root=None,
+    ):
+        self.kernel_memory = kernel_memory * 1024 * 1024
+        self.user_memory = user_memory * 1024 * 1024
+        self.cpu_weight = cpu_weight
+        self.address_space = address_space * 1024 * 1024
+
+        self.cgroup_root = None
+        if cgroup_root is not None:
+            if os.path.exists(
+                os.path.join(cgroup_root, "cgroup.controllers")
+            ) and os.access(cgroup_root, os.W_OK):
+                self.cgroup_root = cgroup_root
+            else:
+                self._log.warning(
+                    f"Can't use {cgroup_root} as cgroup v2 root, falling back to sampling memory usage"
+                )
+
+    def _cgroup(self, path, memory, cpu_weight=0):
+        # Creates the cgroup at path if it doesn't exist, with memory and cpu controllers enabled by its parent
+        with open(
+            os.path.join(os.path.dirname(path), "cgroup.subtree_control"), "w"
+        ) as f:
+            f.write("+memory +cpu")
+        os.makedirs(path, exist_ok=True)
+        if memory > 0:
+            with open(os.path.join(path, "memory.max"), "w") as f:
+                f.write(str(memory))
+        if cpu_weight > 0:
+            with open(os.path.join(path, "cpu.weight"), "w") as f:
+                f.write(str(cpu_weight))
+
+    def user_cgroup(self, username):
+        return os.path.join(self.cgroup_root, username)
+
+    def kernel_cgroup(self, username, kernel_id):
+        return os.path.join(self.user_cgroup(username), kernel_id)
+
+    def apply(self, username, kernel_id, pid):
+        # Called with each new process of a kernel. Any processes it already started are limited too, while those
+        # it starts later inherit the limits. Failures are logged, since the kernel works without its limits.
+        if (
+            self.address_space == 0
+            and self.cgroup_root is None
+            and self.cpu_weight == 0
+        ):
+            return
+        pids = process_tree(read_processes(), pid)
+        try:
+            if self.cgroup_root is not None:
+                self._cgroup(self.user_cgroup(username), self.user_memory)
+                path = self.kernel_cgroup(username, kernel_id)
+                self._cgroup(path, self.kernel_memory, self.cpu_weight)
+            for p in pids:
+                if self.address_space > 0:
+                    resource.prlimit(
+                        p, resource.RLIMIT_AS, (self.address_space, self.address_space)
+                    )
+                if self.cgroup_root is not None:
+                    # Only one pid can be written at a time
+                    with open(os.path.join(path, "cgroup.procs"), "w") as f:
+                        f.write(str(p))
+                elif self.cpu_weight > 0:
+                    os.setpriority(os.PRIO_PROCESS, p, cpu_nice(self.cpu_weight))
+        except OSError as e:
+            self._log.warning(f"Failed to limit kernel {kernel_id}: {e}")
+
+    def memory_events(self, path):
+        # The counts of the cgroup's memory events, such as "oom" (the cgroup's own limit was reached, and processes
+        # were killed) and "oom_kill" (processes in the cgroup were killed for any reason). Events of descendant cgroups
+        # are left out when the kernel supports it.
+        for name in ("memory.events.local", "memory.events"):
+            try:
+                with open(os.path.join(path, name)) as f:
+                    return {key: int(value) for key, value in (l.split() for l in f)}
+            except OSError:
+                continue
+        return {}
+
+    def release(self, username, kernel_id, timeout=2):
+        # Removes the kernel's cgroup once it was shut down, which only works once its processes exited
+        if self.cgroup_root is None:
+            return
+        end = time.monotonic() + timeout
+        while True:
+            try:
+                os.rmdir(self.kernel_cgroup(username, kernel_id))
+                return
+            except FileNotFoundError:
+                return
+            except OSError as e:
+                if time.monotonic() > end:
+                    self._log.warning(
+                        f"Failed to remove cgroup of kernel {kernel_id}: {e}"
+                    )
+                    return
+            time.sleep(0.1)
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+
+class Cron:
+    """
+    Cron is a schedule given by the five fields of a crontab line: minute, hour, day of month, month and day of week.
+    Each field is *, a number, a range a-b, a step */n or a-b/n, or a comma-separated list of these.
+    As in cron, if both day fields are restricted, a day matches if either of them does.
+    """
+
+    limits = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Schedule '{expression}' must have 5 fields")
+        self.expression = expression
+        try:
+            self.minutes, self.hours, self.days, self.months, self.weekdays = [
+                self._parse(f, lo, hi) for f, (lo, hi) in zip(fields, self.limits)
+            ]
+        except ValueError:
+            raise ValueError(f"Invalid schedule '{expression}'")
+        # Sunday is both 0 and 7
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _parse(field, lo, hi):
+        values = set()
+        for item in field.split(","):
+            step = 1
+            if "/" in item:
+                item, step = item.split("/", 1)
+                step = int(step)
+            if item == "*":
+                start, end = lo, hi
+            elif "-" in item:
+                start, end = [int(v) for v in item.split("-", 1)]
+            else:
+                start = int(item)
+                end = hi if step > 1 else start
+            if start < lo or end > hi or start > end or step < 1:
+                raise ValueError()
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, t):
+        day = t.day in self.days
+        weekday = t.isoweekday() % 7 in self.weekdays
+        if self.any_day:
+            return weekday
+        if self.any_weekday:
+            return day
+        return day or weekday
+
+    def next(self, after):
+        # Returns the first minute after the given local time that matches the schedule
+        t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        end = t + timedelta(days=5 * 366)
+        while t < end:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(
+                    day=1
+                )
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"Schedule '{self.expression}' never runs")
+
+
+class Scheduler:
+    """
+    Scheduler runs notebooks on the schedules in the notebook_schedules table, or on demand. Notebooks are run by calling
+    run(object_id, owner), which returns the status of the run, with at most concurrency notebooks running at a time
+    across all users. Due schedules are checked every interval seconds.
+    """
+
+    _log = logging.getLogger("notebook.Scheduler")
+
+    def __init__(self, database, run, concurrency=2, interval=30):
+        self.database = database
+        self.run = run
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.interval = interval
+        # The object ids of notebooks that are running or waiting to run
+        self.running = set()
+
+    async def loop(self):
+        while True:
+            try:
+                await self.start_due()
+            except Exception:
+                self._log.exception("Failed to start scheduled notebooks")
+            await asyncio.sleep(self.interval)
+
+    async def start_due(self):
+        async with self.database.read() as db:
+            rows = await db.execute_fetchall(
+                "SELECT object_id,owner,cron FROM notebook_schedules WHERE enabled AND next_run<=?;",
+                (time.time(),),
+            )
+        for object_id, owner, cron in rows:
+            # The next run is set before starting, so that a run is not repeated if it fails
+            next_run = Cron(cron).next(datetime.now()).timestamp()
+            async with self.database.write() as db:
+                await db.execute(
+                    "UPDATE notebook_schedules SET next_run=? WHERE object_id=?;",
+                    (next_run, object_id),
+                )
+            self.start(object_id, owner)
+
+    def start(self, object_id, owner):
+        # Starts running the notebook in the background, returning False if it is already running
+        if object_id in self.running:
+            return False
+        self.running.add(object_id)
+        asyncio.create_task(self._run(object_id, owner))
+        return True
+
+    async def _run(self, object_id, owner):
+        try:
+            async with self.semaphore:
+                self._log.info(f"Running notebook {object_id}")
+                start_time = time.time()
+                try:
+                    status = await self.run(object_id, owner)
+                except Exception:
+                    self._log.exception(f"Failed to run notebook {object_id}")
+                    status = "failed"
+                self._log.info(
+                    f"Notebook {object_id} finished with status {status} in {time.time() - start_time:.1f}s"
+                )
+                async with self.database.write() as db:
+                    await db.execute(
+                        "UPDATE notebook_schedules SET last_run=?,last_status=? WHERE object_id=?;",
+                        (start_time, status, object_id),
+                    )
+        finally:
+            self.running.discard(object_id)
+
+    async def get(self, object_id):
+        async with self.database.read() as db:
+            rows = await db.execute_fetchall(
+                "SELECT cron,enabled,next_run,last_run,last_status FROM notebook_schedules WHERE object_id=?;",
+                (object_id,),
+            )
+        if len(rows) == 0:
+            return None
+        return {
+            "cron": rows[0][0],
+            "enabled": bool(rows[0][1]),
+            "next_run": rows[0][2],
+            "last_run": rows[0][3],
+            "last_status": rows[0][4],
+            "running": object_id in self.running,
+        }
+
+    async def set(self, object_id, owner, cron, enabled=True):
+        # Raises a ValueError if the schedule is invalid
+        next_run = Cron(cron).next(datetime.now()).timestamp()
+        async with self.database.write() as db:
+            await db.execute(
+                "INSERT INTO notebook_schedules (object_id,owner,cron,enabled,next_run) VALUES (?,?,?,?,?) ON CONFLICT(object_id) DO UPDATE SET owner=excluded.owner,cron=excluded.cron,enabled=excluded.enabled,next_run=excluded.next_run;",
+                (object_id, owner, cron, enabled, next_run),
+            )
+
+    async def delete(self, object_id):
+        async with self.database.write() as db:
+            await db.execute(
+                "DELETE FROM notebook_schedules WHERE object_id=?;", (object_id,)
+            )
@@ -0,0 +1,90 @@
+import re
+
+# Stdout output can include backspaces \b and carriage returns \r, which we want to explicitly act on the string.
+# For example, "\x1b[?25h\x08 \x08canceled\r\n" shows up when doing %pip install, and progress bars
+# constantly rewrite their line with \r.
+tokens = re.compile(
+    r"\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])|\r\n|\r|\n|\x08|[^\x1B\r\n\x08]+|\x1B"
+)
+# An escape sequence that was cut off at the end of a chunk
+partial_escape = re.compile(r"\x1B(?:\[[0-?]*[ -/]*)?$")
+
+
+class TerminalText:
+    """
+    TerminalText applies terminal control characters to a stream's text incrementally.
+    Only the line currently being written is kept in memory, so that each chunk of output costs
+    time proportional to its own length rather than to the length of the full stream.
+
+    Carriage returns discard the line they end, backspaces remove the preceding character
+    (skipping over ANSI escape sequences), and ANSI sequences are otherwise passed through.
+    """
+
+    def __init__(self, text=""):
+        # The number of characters of finished lines, which can no longer change
+        self.committed = 0
+        # The current line, as a list of [is_escape_sequence, text] segments
+        self.line = []
+        # Whether the current line was ended by a \r which was not (yet) followed by \n
+        self.cr = False
+        # An escape sequence that was not finished in the previous chunk
+        self.pending = ""
+
+        if text != "":
+            # Continue from previously processed text. Everything before the last newline is fixed
+            i = text.rfind("\n") + 1
+            self.write(text[i:])
+            self.committed = i
+
+    def render(self):
+        return (
+            "".join(s[1] for s in self.line) + ("\r" if self.cr else "") + self.pending
+        )
+
+    def _backspace(self):
+        for s in reversed(self.line):
+            if not s[0] and len(s[1]) > 0:
+                s[1] = s[1][:-1]
+                return
+
+    def write(self, chunk):
+        """
+        Applies the chunk, and returns (start, text), meaning that the full stream's text
+        should be replaced from index start onwards with text.
+        """
+        start = self.committed
+        chunk = self.pending + chunk
+        self.pending = ""
+        m = partial_escape.search(chunk)
+        if m is not None:
+            self.pending = chunk[m.start() :]
+            chunk = chunk[: m.start()]
+
+        done = []
+        for t in tokens.findall(chunk):
+            if t == "\n" or t == "\r\n":
+                if self.cr and t == "\r\n":
+                    self.line = []
+                done.append(
+                    "".join(s[1] for s in self.line)
+                    + ("\r\n" if self.cr or t == "\r\n" else "\n")
+                )
+                self.line = []
+                self.cr = False
+                continue
+            if self.cr:
+                # The previous line ended in \r without a newline, so it gets overwritten
+                self.line = []
+                self.cr = False
+            if t == "\r":
+                self.cr = True
+            elif t == "\x08":
+                self._backspace()
+            elif t[0] == "\x1B":
+                self.line.append([True, t])
+            else:
+                self.line.append([False, t])
+
+        done = "".join(done)
+        self.committed += len(done)
+        return start, done + self.render()
@@ -0,0 +1,101 @@
+import asyncio
+import concurrent.futures
+import logging
+from collections import deque
+
+
+class Workers:
+    """
+    Workers runs CPU-heavy work, like parsing and serializing large JSON or processing long terminal output,
+    outside of the event loop, so that one large notebook doesn't stall the requests and kernels of every other user.
+    Handing work to a worker costs more than processing a small payload directly, so only payloads of at least
+    offload_size bytes are sent to the executor, and the rest is processed inline.
+
+    With kind="process", run uses a process pool, which also avoids the GIL, but requires the function and its
+    arguments to be picklable, and the function not to modify its arguments. Work which keeps state in the
+    plugin process goes through run_thread, which always uses threads.
+    """
+
+    _log = logging.getLogger("notebook.Workers")
+
+    def __init__(self, kind="thread", max_workers=4, offload_size=65536):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown worker kind '{kind}'")
+        self.kind = kind
+        self.offload_size = offload_size
+        self.threads = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix="notebook-worker"
+        )
+        if kind == "process":
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers)
+        else:
+            self.executor = self.threads
+
+        self.inline = 0
+        self.offloaded = 0
+
+    async def _run(self, executor, size, fn, *args):
+        if size < self.offload_size:
+            self.inline += 1
+            return fn(*args)
+        self.offloaded += 1
+        return await asyncio.get_event_loop().run_in_executor(executor, fn, *args)
+
+    async def run(self, size, fn, *args):
+        # Runs fn(*args), where size is the size of the payload in bytes
+        return await self._run(self.executor, size, fn, *args)
+
+    async def run_thread(self, size, fn, *args):
+        return await self._run(self.threads, size, fn, *args)
+
+    def close(self):
+        self.threads.shutdown(wait=False)
+        if self.executor is not self.threads:
+            self.executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            "kind": self.kind,
+            "offload_size": self.offload_size,
+            "inline": self.inline,
+            "offloaded": self.offloaded,
+        }
+
+
+class LoopMonitor:
+    """
+    LoopMonitor measures the event loop's lag, which is how much later than scheduled a sleep of interval seconds
+    wakes up, and so how long the loop was blocked from serving requests and kernels. The lags of the last window
+    samples are kept for stats, and lags of at least stall seconds are counted and logged.
+    """
+
+    _log = logging.getLogger("notebook.LoopMonitor")
+
+    def __init__(self, interval=0.25, window=240, stall=0.1):
+        self.interval = interval
+        self.stall = stall
+        self.samples = deque(maxlen=window)
+        self.stalls = 0
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self.samples.append(lag)
+            if lag >= self.stall:
+                self.stalls += 1
+                self._log.debug(f"Event loop was blocked for {lag:.3f}s")
+
+    def stats(self):
+        samples = sorted(self.samples)
+        if len(samples) == 0:
+            return {"samples": 0, "stalls": self.stalls}
+        return {
+            "samples": len(samples),
+            "lag_mean": sum(samples) / len(samples),
+            "lag_p99": samples[int(0.99 * (len(samples) - 1))],
+            "lag_max": samples[-1],
+            "stalls": self.stalls,
+        }
@@ -0,0 +1,94 @@
+"""
+Compares the JSON libraries that backend/codec.py can use, on messages shaped like large notebook outputs.
+
+    python benchmarks/codec.py
+
+Libraries that are not installed are skipped.
+"""
+import base64
+import importlib
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+import codec
+
+
+def execute_result(data):
+    return {
+        "header": {
+            "msg_id": "a1b2c3d4_5e6f",
+            "msg_type": "display_data",
+            "session": "notebook",
+            "date": "2021-01-01T00:00:00.000000Z",
+        },
+        "parent_header": {"msg_id": "cellid_0123456789abcdef"},
+        "metadata": {},
+        "msg_type": "display_data",
+        "channel": "iopub",
+        "content": {"data": data, "metadata": {}},
+    }
+
+
+# A 1MB png plot, a 200 row dataframe rendered as html, and a long stream of progress output
+messages = {
+    "image": execute_result(
+        {
+            "image/png": base64.b64encode(os.urandom(1 << 20)).decode("ascii"),
+            "text/plain": "<Figure size 640x480 with 1 Axes>",
+        }
+    ),
+    "html": execute_result(
+        {
+            "text/html": "<table>"
+            + "".join(
+                f"<tr><td>{i}</td><td>{i * 0.5}</td><td>café ünïcode</td></tr>"
+                for i in range(200)
+            )
+            + "</table>",
+            "text/plain": "dataframe",
+        }
+    ),
+    "stream": {
+        "msg_type": "stream",
+        "parent_header": {"msg_id": "cellid_0123456789abcdef"},
+        "content": {
+            "name": "stdout",
+            "text": "".join(f"step {i}: loss=0.{i:06d}\n" for i in range(20000)),
+        },
+    },
+}
+
+
+def codecs():
+    yield "json", json.loads, json.dumps
+    for name in ("ujson", "orjson"):
+        try:
+            lib = importlib.import_module(name)
+        except ImportError:
+            print(f"{name} is not installed, skipping")
+            continue
+        if name == "orjson":
+            yield name, lib.loads, lambda o: lib.dumps(o).decode("utf-8")
+        else:
+            yield name, lib.loads, lib.dumps
+
+
+def bench(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1000
+
+
+if __name__ == "__main__":
+    print(f"backend codec: {codec.name}\n")
+    print(
+        f"{'message':10} {'size':>10} {'library':8} {'loads ms':>10} {'dumps ms':>10}"
+    )
+    for mname, msg in messages.items():
+        text = json.dumps(msg)
+        number = max(1, 2000000 // len(text))
+        for cname, loads, dumps in codecs():
+            tl = bench(lambda: loads(text), number)
+            td = bench(lambda: dumps(msg), number)
+            print(f"{mname:10} {len(text):>10} {cname:8} {tl:>10.3f} {td:>10.3f}")
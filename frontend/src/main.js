@@ -69,6 +69,20 @@ function setup(app) {
             cell_id: e.data.cell_id,
             data: e.data
         }));
+        app.websocket.subscribe("notebook_run_progress", {
+            event: "notebook_run_progress",
+            user: app.info.user.username
+        }, (e) => app.store.dispatch("notebookRunProgress", {
+            id: e.object,
+            data: e.data
+        }));
+        app.websocket.subscribe("notebook_kernel_limit", {
+            event: "notebook_kernel_limit",
+            user: app.info.user.username
+        }, (e) => app.store.dispatch("notebookKernelLimit", {
+            id: e.object,
+            data: e.data
+        }));
         app.websocket.subscribe("notebook_kernel_state", {
             event: "notebook_kernel_state",
             user: app.info.user.username
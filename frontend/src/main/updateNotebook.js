@@ -79,6 +79,31 @@ export function deduplicateUpdate(notebook, changeList, appliedChanges) {
     return changeList.slice(appliedChanges.length, changeList.length);
 }
 
+function sliceCodePoints(s, n) {
+    // The backend counts characters in code points, while javascript strings are indexed by UTF-16 code units
+    if (!/[\uD800-\uDFFF]/.test(s)) return s.substring(0, n);
+    return Array.from(s).slice(0, n).join("");
+}
+
+export function applyOutputOps(outputs, ops) {
+    // Applies the changes given in a notebook_cell_outputs event to a cell's outputs. Each op either appends
+    // an output at seq, or replaces the text of the stream output at seq from index start onwards.
+    outputs = [...outputs];
+    for (let op of ops) {
+        if (op.op == "append") {
+            outputs[op.seq] = op.output;
+        } else if (op.op == "stream") {
+            let text = outputs[op.seq].text;
+            if (Array.isArray(text)) text = text.join("");
+            outputs[op.seq] = {
+                ...outputs[op.seq],
+                text: sliceCodePoints(text, op.start) + op.text
+            };
+        }
+    }
+    return outputs;
+}
+
 export default function updateNotebook(notebook, changeList, markModified = false) {
     // updateNotebook gets the object representing the notebook, and returns the equivalent object
     // with the given modifictions applied.
@@ -5,6 +5,7 @@ import api from "../../util.mjs";
 
 import updateNotebook, {
     addUpdate,
+    applyOutputOps,
     deduplicateUpdate
 } from "./updateNotebook.js";
 
@@ -122,6 +123,31 @@ export default {
                 return;
             }
             let dedup_key = `${q.id}/${q.cell_id}`;
+            // Events carry the cell's new version, so there is no need to read a cell that is already up to date
+            let isCurrent = () => {
+                let cell = state.notebooks[q.id].notebook[q.cell_id];
+                return q.data.version !== undefined && cell !== undefined && cell.version !== undefined && cell.version >= q.data.version;
+            };
+            if (isCurrent()) {
+                console.vlog(`Cell ${dedup_key} is already at version ${q.data.version}`);
+                return;
+            }
+            if (q.data.ops !== undefined) {
+                // The event holds the changes to the outputs, which can be applied if we have the version they are based on
+                let cell = state.notebooks[q.id].notebook[q.cell_id];
+                if (cell !== undefined && cell.version === q.data.base_version) {
+                    console.vlog(`Applying output changes contained in event message for ${dedup_key}`);
+                    commit("applyNotebookUpdates", {
+                        id: q.id,
+                        updates: [{
+                            cell_id: q.cell_id,
+                            version: q.data.version,
+                            outputs: applyOutputOps(cell.outputs, q.data.ops)
+                        }]
+                    });
+                    return;
+                }
+            }
             if (state.cell_update_dedup[dedup_key] !== undefined) {
                 let dkey = state.cell_update_dedup[dedup_key];
                 if (dkey != null) {
@@ -132,6 +158,9 @@ export default {
                     commit("setDedup", { key: dedup_key, value: resolve });
                 }));
                 console.vlog(`Resuming cell read for ${dedup_key}`);
+                if (isCurrent()) {
+                    return;
+                }
             } else if (q.data.outputs !== undefined) {
                 console.vlog(`Using cell output contained in event message for ${dedup_key}`);
                 // Outputs were sent in the message itself, so set them directly!
@@ -152,10 +181,14 @@ export default {
                 return
 
             }
-            commit("applyNotebookUpdates", {
-                id: q.id,
-                updates: [res.data]
-            });
+            let cell = state.notebooks[q.id].notebook[q.cell_id];
+            if (cell === undefined || cell.version === undefined || res.data == null || !(cell.version > res.data.version)) {
+                // Changes from events might have been applied while reading, in which case the read cell is outdated
+                commit("applyNotebookUpdates", {
+                    id: q.id,
+                    updates: [res.data]
+                });
+            }
             commit("clearDedup", { key: dedup_key });
 
         },
@@ -221,24 +254,58 @@ export default {
 
             let ntb = Object.values(state.notebooks[q.id].notebook);
             ntb.sort((a, b) => a["cell_index"] - b["cell_index"]);
-            for (let c of ntb) {
-                if (c.cell_type == "code") {
-                    console.vlog("Running cell", q.id, c.cell_id);
+            let cells = ntb.filter((c) => c.cell_type == "code").map((c) => ({
+                cell_id: c.cell_id,
+                source: c.source
+            }));
+            console.vlog("Running cells", q.id, cells.length);
 
-                    let res = await api("POST", `api/objects/${q.id}/notebook/kernel`, {
-                        cell_id: c.cell_id,
-                        source: c.source
-                    });
-                    if (!res.response.ok) {
-                        commit("alert", {
-                            type: "error",
-                            text: res.data.error_description
-                        });
+            // All cells are sent at once, and the backend queues them in the kernel
+            let res = await api("POST", `api/objects/${q.id}/notebook/kernel/run`, {
+                cells: cells
+            });
+            if (!res.response.ok) {
+                commit("alert", {
+                    type: "error",
+                    text: res.data.error_description
+                });
 
-                    }
-                }
             }
-
+        },
+        notebookRunProgress: async function ({
+            state,
+            commit
+        }, q) {
+            if (state.notebooks[q.id] === undefined || state.notebooks[q.id].notebook == null || q.data.cells === undefined) {
+                return;
+            }
+            // The cells of a run have their outputs cleared when the run starts
+            let notebook = state.notebooks[q.id].notebook;
+            let updates = q.data.cells.filter((cell_id) => notebook[cell_id] !== undefined && !(notebook[cell_id].version >= q.data.version)).map((cell_id) => ({
+                cell_id: cell_id,
+                outputs: [],
+                version: q.data.version
+            }));
+            if (updates.length > 0) {
+                commit("applyNotebookUpdates", {
+                    id: q.id,
+                    updates: updates
+                });
+            }
+        },
+        notebookKernelLimit: async function ({
+            state,
+            commit
+        }, q) {
+            if (state.notebooks[q.id] === undefined) {
+                return;
+            }
+            let mb = (b) => Math.round(b / (1024 * 1024));
+            let scope = q.data.scope == "user" ? "all of your kernels" : "the kernel";
+            commit("alert", {
+                type: "warning",
+                text: `The notebook's kernel ${q.data.stopped ? "was shut down" : "was killed"}, since ${scope} used ${mb(q.data.usage)}MB of memory, more than the limit of ${mb(q.data.limit)}MB`
+            });
         },
         getNotebookStatus: async function ({
             state,